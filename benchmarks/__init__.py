@@ -0,0 +1,6 @@
+"""Benchmarks for nominaldelta.
+
+``python -m benchmarks`` runs the suite in ``benchmarks/__main__.py``. The
+other modules are focused comparisons that can be run on their own, e.g.
+``python -m benchmarks.month_search``.
+"""
@@ -0,0 +1,220 @@
+"""Benchmark suite for the nominaldelta hot paths.
+
+Usage::
+
+    python -m benchmarks [-k PATTERN] [-o results.json]
+    python -m benchmarks compare old.json new.json [--threshold 0.05]
+"""
+
+import argparse
+import itertools
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timezone
+from zoneinfo import ZoneInfo
+
+from nominaldelta import NominalDelta
+from nominaldelta import Schedule
+
+# two-sided 95% quantiles of Student's t distribution by degrees of freedom
+T_95 = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31}
+T_95.update({9: 2.26, 10: 2.23, 15: 2.13, 20: 2.09, 30: 2.04})
+
+
+def cases():
+    a = NominalDelta(months=14, days=3, seconds=7)
+    b = NominalDelta(days=2, seconds=-90)
+    month = NominalDelta(months=1)
+    mixed = NominalDelta(months=1, days=2, hours=3)
+    tz = ZoneInfo('Europe/Berlin')
+
+    yield 'construct', lambda: NominalDelta(months=1, days=2, hours=3)
+    yield 'delta + delta', lambda: a + b
+    yield 'delta - delta', lambda: a - b
+    yield '-delta', lambda: -a
+    yield 'delta * int', lambda: a * 3
+    yield 'hash', lambda: hash(a)
+    yield 'delta == delta', lambda: a == b
+    fa = NominalDelta(days=1, seconds=0.1)
+    fb = NominalDelta(seconds=-2.25)
+    yield 'delta + delta (fractional)', lambda: fa + fb
+    yield 'delta * int (fractional)', lambda: fa * 3
+    yield 'hash (fractional)', lambda: hash(fa)
+    yield 'delta == delta (fractional)', lambda: fa == fb
+    yield 'fromisoformat', lambda: NominalDelta.fromisoformat('P1Y2M10DT2H30M')
+    yield 'isoformat', lambda: a.isoformat()
+
+    d = date(2021, 1, 15)
+    yield 'date + months', lambda: d + month
+    d_end = date(2021, 1, 31)
+    yield 'date + months (month end)', lambda: d_end + month
+    yield 'date + months/days (month end)', lambda: d_end + mixed
+
+    for name, tzinfo in [('naive', None), ('UTC', timezone.utc), ('ZoneInfo', tz)]:
+        dt = datetime(2021, 1, 31, 13, 30, tzinfo=tzinfo)
+        yield f'datetime + months ({name})', lambda dt=dt: dt + month
+        yield f'datetime + mixed ({name})', lambda dt=dt: dt + mixed
+        yield f'datetime + fractional ({name})', lambda dt=dt: dt + fa
+
+    for name, start, end in [
+        ('date, 10 days', date(2021, 1, 15), date(2021, 1, 25)),
+        ('date, 100 years', date(1921, 1, 31), date(2021, 1, 15)),
+        ('datetime, 10 days', datetime(2021, 1, 15, 13), datetime(2021, 1, 25, 2)),
+        (
+            'datetime, 100 years',
+            datetime(1921, 1, 31, 13),
+            datetime(2021, 1, 15, 2),
+        ),
+        (
+            'ZoneInfo, 100 years',
+            datetime(1921, 1, 31, 13, tzinfo=tz),
+            datetime(2021, 1, 15, 2, tzinfo=tz),
+        ),
+    ]:
+        yield f'diff ({name})', lambda a=start, b=end: NominalDelta.diff(a, b)
+
+    today = date(2021, 1, 15)
+    births = [date(1921, 1, 31) + NominalDelta(days=k) for k in range(0, 30000, 90)]
+    yield 'diff_from (date, 334 values)', lambda: list(
+        NominalDelta.diff_from(today, births)
+    )
+
+    quarter = NominalDelta(months=3)
+    anchor = date(2020, 1, 31)
+    event = date(2024, 5, 17)
+    yield 'bucket_index (quarter)', lambda: quarter.bucket_index(event, anchor)
+    events = [anchor + NominalDelta(days=k) for k in range(0, 1000, 3)]
+    yield 'bucket_many (quarter, 334 events)', lambda: list(
+        quarter.bucket_many(events, anchor)
+    )
+
+    schedule = Schedule(
+        (anchor + NominalDelta(days=k % 365), [month, quarter][k % 2])
+        for k in range(1000)
+    )
+    yield 'Schedule (1000 rules, 1000 occurrences)', lambda: list(
+        itertools.islice(schedule, 1000)
+    )
+    yield 'Schedule (1000 rules, start)', lambda: next(schedule.occurrences(event))
+
+
+def calibrate(func, min_time):
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= min_time:
+            return number
+        number *= 2
+
+
+def measure(func, repeat, min_time):
+    number = calibrate(func, min_time)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append(number / (time.perf_counter() - start))
+    mean = statistics.mean(samples)
+    df = repeat - 1
+    t = T_95.get(df) or T_95[max(k for k in T_95 if k <= df)]
+    ci = t * statistics.stdev(samples) / math.sqrt(repeat)
+    return {'ops': mean, 'ci': ci, 'samples': samples}
+
+
+def run(args):
+    results = {}
+    for name, func in cases():
+        if args.k and args.k not in name:
+            continue
+        result = measure(func, args.repeat, args.min_time)
+        results[name] = result
+        print(
+            f'{name:<36} {result["ops"]:>14,.0f} ops/s '
+            f'± {result["ci"] / result["ops"]:>5.1%}'
+        )
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'implementation': platform.python_implementation(),
+                    'machine': platform.machine(),
+                    'results': results,
+                },
+                fh,
+                indent=2,
+            )
+    return 0
+
+
+def compare(args):
+    with open(args.old) as fh:
+        old = json.load(fh)['results']
+    with open(args.new) as fh:
+        new = json.load(fh)['results']
+
+    regressions = 0
+    for name in old:
+        if name not in new:
+            continue
+        change = new[name]['ops'] / old[name]['ops'] - 1
+        # only flag changes that are larger than the threshold and the noise
+        significant = (
+            new[name]['ops'] + new[name]['ci'] < old[name]['ops'] - old[name]['ci']
+        )
+        flag = ''
+        if change < -args.threshold and significant:
+            flag = 'REGRESSION'
+            regressions += 1
+        print(f'{name:<36} {change:>+7.1%} {flag}'.rstrip())
+    return 1 if regressions else 0
+
+
+def repeat_type(value):
+    # the confidence interval needs a standard deviation, so at least two samples
+    try:
+        repeat = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid int value: {value!r}') from None
+    if repeat < 2:
+        raise argparse.ArgumentTypeError('must be at least 2')
+    return repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.set_defaults(func=run, k=None, output=None, repeat=10, min_time=0.05)
+    parser.add_argument('-k', help='only run benchmarks containing this string')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument(
+        '--repeat', type=repeat_type, help='number of samples (default: 10)'
+    )
+    parser.add_argument(
+        '--min-time', type=float, help='seconds per sample (default: 0.05)'
+    )
+    subparsers = parser.add_subparsers()
+    compare_parser = subparsers.add_parser('compare', help='compare two JSON files')
+    compare_parser.set_defaults(func=compare)
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.05,
+        help='relative slowdown that counts as regression (default: 0.05)',
+    )
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Measure date_add for days in the middle and at the end of a month.
+
+Run with ``python -m benchmarks.date_add``.
+"""
+
+import timeit
+from datetime import date
+from functools import partial
+
+from nominaldelta import NominalDelta
+from nominaldelta import date_add
+
+CASES = [
+    ('mid-month + 1 month', date(2021, 1, 15), NominalDelta(months=1)),
+    ('month-end + 1 month', date(2021, 1, 31), NominalDelta(months=1)),
+    ('month-end + 1 month, leap', date(2020, 1, 31), NominalDelta(months=1)),
+    ('month-end + 1 month 1 day', date(2021, 1, 31), NominalDelta(months=1, days=1)),
+    ('month-end + 1 year', date(2020, 2, 29), NominalDelta(years=1)),
+]
+
+
+def main():
+    number = 200_000
+    for name, dt, delta in CASES:
+        func = partial(date_add, dt, delta)
+        t = min(timeit.repeat(func, number=number, repeat=5))
+        print(f'{name:<28} {t / number * 1e9:6.0f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Measure memory and throughput of NominalDelta objects.
+
+Run with ``python -m benchmarks.delta``.
+"""
+
+import timeit
+import tracemalloc
+
+from nominaldelta import NominalDelta
+
+N = 1_000_000
+
+
+def memory():
+    tracemalloc.start()
+    deltas = [NominalDelta(months=i, days=i, seconds=i) for i in range(N)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del deltas
+    return size / N
+
+
+def ops(stmt, number=200_000):
+    a = NominalDelta(months=14, days=3, seconds=7)
+    b = NominalDelta(days=2, seconds=-90)
+    env = {'a': a, 'b': b, 'NominalDelta': NominalDelta}
+    return number / min(timeit.repeat(stmt, globals=env, number=number, repeat=5))
+
+
+def main():
+    print(f'memory per delta: {memory():.0f} bytes')
+    for stmt in [
+        'NominalDelta(months=1, days=2)',
+        'a + b',
+        'a - b',
+        '-a',
+        'a * 3',
+        'hash(a)',
+        'a == b',
+    ]:
+        print(f'{stmt:<32} {ops(stmt) / 1e6:6.2f} M ops/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Measure dt_add for different kinds of tzinfo.
+
+Run with ``python -m benchmarks.dt_add``.
+"""
+
+import timeit
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from functools import partial
+from zoneinfo import ZoneInfo
+
+from nominaldelta import NominalDelta
+from nominaldelta import dt_add
+
+ZONES = [
+    ('naive', None),
+    ('UTC', timezone.utc),
+    ('fixed offset', timezone(timedelta(hours=5, minutes=30))),
+    ('ZoneInfo', ZoneInfo('Europe/Berlin')),
+]
+DELTAS = [
+    ('months', NominalDelta(months=1)),
+    ('months+hours', NominalDelta(months=1, hours=3)),
+    ('hours', NominalDelta(hours=3)),
+]
+
+
+def main():
+    number = 100_000
+    print(f'{"":<14}' + ''.join(f'{name:>14}' for name, _ in DELTAS))
+    for zone_name, tz in ZONES:
+        dt = datetime(2021, 1, 31, 13, 30, tzinfo=tz)
+        row = f'{zone_name:<14}'
+        for _, delta in DELTAS:
+            func = partial(dt_add, dt, delta)
+            t = min(timeit.repeat(func, number=number, repeat=7))
+            row += f'{t / number * 1e9:>11.0f} ns'
+        print(row)
+
+
+if __name__ == '__main__':
+    main()
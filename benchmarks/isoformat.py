@@ -0,0 +1,74 @@
+"""Compare ISO 8601 duration parsing against a naive regex approach.
+
+Run with ``python -m benchmarks.isoformat``.
+"""
+
+import io
+import re
+import time
+
+from nominaldelta import NominalDelta
+
+N = 200_000
+SAMPLES = ['P1Y2M10DT2H30M', 'P1M', 'PT15M', 'P3W', '-P1D', 'PT0.5S', 'P2Y', 'PT1H']
+
+
+def naive(s):
+    # one search per component, like the ad-hoc parsers this replaces
+    sign = -1 if s.startswith('-') else 1
+    date, _, time = s.lstrip('+-')[1:].partition('T')
+    values = {}
+    for key, part, unit in [
+        ('years', date, 'Y'),
+        ('months', date, 'M'),
+        ('weeks', date, 'W'),
+        ('days', date, 'D'),
+        ('hours', time, 'H'),
+        ('minutes', time, 'M'),
+        ('seconds', time, 'S'),
+    ]:
+        match = re.search(rf'(\d+(?:[.,]\d+)?){unit}', part)
+        if match:
+            value = match.group(1).replace(',', '.')
+            value = float(value) if '.' in value else int(value)
+            values[key] = sign * value
+    return NominalDelta(**values)
+
+
+def measure(func, text):
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in func(io.StringIO(text)):
+            pass
+        best = min(best, time.perf_counter() - start)
+    return N / best
+
+
+def fromisoformat(fh):
+    return map(NominalDelta.fromisoformat, map(str.strip, fh))
+
+
+def main():
+    repeated = ''.join(SAMPLES[i % len(SAMPLES)] + '\n' for i in range(N))
+    unique = ''.join(f'P{i}DT{i % 24}H{i % 60}M\n' for i in range(N))
+    for name, func in [
+        ('naive regex', lambda fh: (naive(line.strip()) for line in fh)),
+        ('fromisoformat', fromisoformat),
+        ('parse_many', NominalDelta.parse_many),
+    ]:
+        print(
+            f'{name:<16} {measure(func, repeated) / 1e6:6.2f} M lines/s (repeated) '
+            f'{measure(func, unique) / 1e6:6.2f} M lines/s (unique)'
+        )
+
+    deltas = [NominalDelta.fromisoformat(s) for s in SAMPLES] * (N // len(SAMPLES))
+    start = time.perf_counter()
+    for delta in deltas:
+        delta.isoformat()
+    rate = len(deltas) / (time.perf_counter() - start)
+    print(f'{"isoformat":<16} {rate / 1e6:6.2f} M deltas/s')
+
+
+if __name__ == '__main__':
+    main()
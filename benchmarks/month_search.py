@@ -0,0 +1,38 @@
+"""Compare month_search to binary_search for spans from 1 day to 100 years.
+
+Run with ``python -m benchmarks.month_search``.
+"""
+
+import timeit
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from nominaldelta import NominalDelta
+from nominaldelta import binary_search
+from nominaldelta import month_search
+
+SPANS = [1, 30, 365, 10 * 365, 50 * 365, 100 * 365]
+MONTH = NominalDelta(months=1)
+
+
+def bench(func, a, b, number=2000):
+    return min(timeit.repeat(lambda: func(a, b, MONTH), number=number, repeat=5))
+
+
+def main():
+    print(f'{"type":<9} {"days":>6} {"binary":>10} {"closed":>10} {"speedup":>8}')
+    for start in [date(1970, 1, 31), datetime(1970, 1, 31, 13)]:
+        for days in SPANS:
+            end = start + timedelta(days=days)
+            old = bench(binary_search, start, end)
+            new = bench(month_search, start, end)
+            print(
+                f'{type(start).__name__:<9} {days:>6} '
+                f'{old / 2000 * 1e6:>8.2f}us {new / 2000 * 1e6:>8.2f}us '
+                f'{old / new:>7.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Measure how diff_parallel() and add_parallel() scale with the worker count.
+
+Run with ``python -m benchmarks.parallel [N]``. ``benchmarks.threads`` runs the
+same measurement for map_diff() and map_add().
+"""
+
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+
+from nominaldelta import NominalDelta
+from nominaldelta import add_parallel
+from nominaldelta import diff_parallel
+from nominaldelta import map_add
+from nominaldelta import map_diff
+
+
+def gil_enabled():
+    # sys._is_gil_enabled() only exists on 3.13+
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+
+def main(threads=False):
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    tz = ZoneInfo('Europe/Berlin')
+    start = datetime(2000, 1, 31, 13, 30, tzinfo=tz)
+    a = [start + timedelta(hours=7 * i) for i in range(n)]
+    b = [dt + timedelta(days=400, minutes=5) for dt in a]
+    delta = NominalDelta(months=1, days=2, hours=3)
+    if threads:
+        diff_func, add_func, label = map_diff, map_add, 'threads'
+    else:
+        diff_func, add_func, label = diff_parallel, add_parallel, 'workers'
+
+    t = time.perf_counter()
+    for x, y in zip(a, b):
+        NominalDelta.diff(x, y)
+    serial_diff = time.perf_counter() - t
+    t = time.perf_counter()
+    for x in a:
+        x + delta
+    serial_add = time.perf_counter() - t
+
+    print(f'python: {platform.python_implementation()} {platform.python_version()}')
+    print(f'GIL: {"enabled" if gil_enabled() else "disabled"}, cpus: {os.cpu_count()}')
+    print(
+        f'{"serial":<12} diff: {n / serial_diff:>10,.0f} pairs/s        '
+        f'add: {n / serial_add:>10,.0f} values/s'
+    )
+
+    workers = 1
+    while workers <= max(8, os.cpu_count() or 1):
+        t = time.perf_counter()
+        for _ in diff_func(zip(a, b), workers=workers):
+            pass
+        diff = time.perf_counter() - t
+        t = time.perf_counter()
+        for _ in add_func(a, delta, workers=workers):
+            pass
+        add = time.perf_counter() - t
+        print(
+            f'{workers:>3} {label:<8} diff: {n / diff:>10,.0f} pairs/s '
+            f'({serial_diff / diff:4.2f}x)  add: {n / add:>10,.0f} values/s '
+            f'({serial_add / add:4.2f}x)'
+        )
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
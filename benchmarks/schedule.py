@@ -0,0 +1,84 @@
+"""Compare Schedule against materializing every recurrence and sorting.
+
+Run with ``python -m benchmarks.schedule [RULES]``.
+"""
+
+import itertools
+import random
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+from nominaldelta import NominalDelta
+from nominaldelta import Schedule
+
+STEPS = [
+    NominalDelta(months=1),
+    NominalDelta(weeks=2),
+    NominalDelta(months=3),
+    NominalDelta(years=1),
+]
+HORIZON = date(2026, 1, 1)
+
+
+def make_rules(n):
+    rng = random.Random(0)
+    return [
+        (date(2020, 1, 1) + NominalDelta(days=rng.randrange(365)), rng.choice(STEPS))
+        for _ in range(n)
+    ]
+
+
+def materialize(rules):
+    # the approach Schedule replaces: repeated addition, then one big sort
+    result = []
+    for i, (anchor, step) in enumerate(rules):
+        item = anchor
+        while item < HORIZON:
+            result.append((item, i))
+            item = item + step
+    result.sort()
+    return result
+
+
+def measure(func):
+    # tracing slows everything down, so time and memory use separate runs
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rules = make_rules(n)
+    schedule = Schedule(rules)
+
+    for name, func in [
+        ('materialize + sort', lambda: len(materialize(rules))),
+        ('Schedule', lambda: sum(1 for _ in schedule.occurrences(stop=HORIZON))),
+    ]:
+        count, elapsed, peak = measure(func)
+        print(
+            f'{name:<22} {count:>10,} occurrences {elapsed:7.2f}s '
+            f'{count / elapsed:>10,.0f}/s  peak {peak / 2**20:7.1f} MiB'
+        )
+
+    # fast-forward: the first 1000 occurrences after a late start
+    start = date(2025, 6, 1)
+    _, elapsed, peak = measure(
+        lambda: list(itertools.islice(schedule.occurrences(start), 1000))
+    )
+    print(
+        f'{"Schedule from 2025-06":<22} {1000:>10,} occurrences {elapsed:7.2f}s '
+        f'{"":>12} peak {peak / 2**20:7.1f} MiB'
+    )
+
+
+if __name__ == '__main__':
+    main()
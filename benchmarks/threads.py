@@ -0,0 +1,11 @@
+"""Measure how map_diff() and map_add() scale with the thread count.
+
+Run with ``python -m benchmarks.threads [N]``. With the GIL, threads cannot
+run Python code in parallel, so expect no speedup unless the interpreter is a
+free-threaded build (e.g. ``python3.13t``).
+"""
+
+from .parallel import main
+
+if __name__ == '__main__':
+    main(threads=True)
@@ -1,55 +1,421 @@
+import itertools
+import operator
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from collections import deque
+from collections.abc import Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
+from contextvars import copy_context
+from datetime import MAXYEAR
+from datetime import MINYEAR
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from heapq import heapify
+from heapq import heappop
+from heapq import heapreplace
+from threading import Lock
 from typing import TypeVar
 
+COUNTERS = [
+    'binary_search_probes',
+    'month_search_probes',
+    'date_add_clips',
+    'dt_add_round_trips',
+    'diff_corrections',
+]
+# counting() keeps the counters in a context variable. _counting is the
+# number of active counting() contexts in all threads, so the hot paths only
+# need to look up the context variable while any of them is active.
+_counters = ContextVar('nominaldelta_counters', default=None)
+_counting = 0
+_counters_lock = Lock()
+_cache = None
+# set by caching(), takes precedence over the process wide _cache
+_context_cache = ContextVar('nominaldelta_cache', default=None)
+
 Self = TypeVar('Self', bound='NominalDelta')
 Date = TypeVar('Date', bound=date)
 
 
+# PnYnMnWnDTnHnMnS with optional signs and fractional seconds
+_ISO_DURATION = re.compile(
+    r'([+-]?)P(?!$)'
+    r'(?:([+-]?\d+)Y)?(?:([+-]?\d+)M)?(?:([+-]?\d+)W)?(?:([+-]?\d+)D)?'
+    r'(?:T(?!$)(?:([+-]?\d+)H)?(?:([+-]?\d+)M)?(?:([+-]?\d+(?:[.,]\d+)?)S)?)?'
+)
+
+DAYS_IN_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+DAYS_BEFORE_MONTH = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334]
+
+
+def is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
 def date_add(dt, delta):
-    total_months = dt.year * 12 + dt.month + delta.months
-    year, month = divmod(total_months, 12)
-    if month == 0:
-        year -= 1
-        month = 12
+    year, month = divmod(dt.year * 12 + dt.month - 1 + delta.months, 12)
+    month += 1
+    if not MINYEAR <= year <= MAXYEAR:
+        raise OverflowError('date value out of range')
 
     # clip day to month
     day = dt.day
-    while day > 0:
-        try:
-            tmp = dt.__class__(year, month, day)
-            break
-        except ValueError:
-            day -= 1
+    if day > 28:
+        days_in_month = DAYS_IN_MONTH[month - 1] + (month == 2 and is_leap(year))
+        if day > days_in_month:
+            day = days_in_month
+            if _counting:
+                _count('date_add_clips')
+
+    if not delta.days:
+        return dt.__class__(year, month, day)
 
-    return dt.__class__.fromordinal(tmp.toordinal() + delta.days)
+    y = year - 1
+    ordinal = y * 365 + y // 4 - y // 100 + y // 400 + DAYS_BEFORE_MONTH[month - 1]
+    if month > 2 and is_leap(year):
+        ordinal += 1
+    return dt.__class__.fromordinal(ordinal + day + delta.days)
 
 
 def dt_add(dt, delta):
-    d = date_add(dt.date(), delta)
-    tmp = dt.__class__.combine(d, dt.time(), tzinfo=dt.tzinfo)
-    return dt.__class__.fromtimestamp(
-        tmp.timestamp() + delta.seconds, tz=dt.tzinfo
+    if delta.months or delta.days:
+        d = date_add(dt.date(), delta)
+        tmp = dt.__class__.combine(d, dt.time(), tzinfo=dt.tzinfo)
+    else:
+        tmp = dt
+
+    microseconds = delta._microseconds
+    if dt.tzinfo.__class__ is timezone:
+        # wall clock and absolute time agree for fixed offsets
+        if tmp.fold:
+            tmp = tmp.replace(fold=0)
+        if microseconds:
+            return tmp + timedelta(microseconds=microseconds)
+        return tmp
+
+    if _counting:
+        _count('dt_add_round_trips')
+    # inlined _timestamp_us() and _fromtimestamp_us(), this is the hot path
+    microsecond = tmp.microsecond
+    if microsecond:
+        seconds = round(tmp.timestamp() - microsecond / 1_000_000)
+        timestamp = seconds * 1_000_000 + microsecond + microseconds
+    else:
+        timestamp = int(tmp.timestamp()) * 1_000_000 + microseconds
+    if -_FLOAT_EXACT < timestamp < _FLOAT_EXACT:
+        return dt.__class__.fromtimestamp(timestamp / 1_000_000, tz=dt.tzinfo)
+    return _fromtimestamp_us(dt.__class__, timestamp, dt.tzinfo)
+
+
+def _timestamp_us(dt):
+    # exact timestamp in microseconds. timestamp() is a float that may be off
+    # in the last microsecond, but it is always close enough to recover the
+    # whole seconds.
+    microsecond = dt.microsecond
+    if microsecond:
+        seconds = round(dt.timestamp() - microsecond / 1_000_000)
+        return seconds * 1_000_000 + microsecond
+    return int(dt.timestamp()) * 1_000_000
+
+
+# microsecond timestamps below this convert to float without losing precision
+# (roughly the years 1834 to 2106)
+_FLOAT_EXACT = 2**32 * 1_000_000
+
+
+def _fromtimestamp_us(cls, timestamp, tzinfo):
+    if -_FLOAT_EXACT < timestamp < _FLOAT_EXACT:
+        # the float is off by less than half a microsecond, which
+        # fromtimestamp() rounds away
+        return cls.fromtimestamp(timestamp / 1_000_000, tz=tzinfo)
+    seconds, microseconds = divmod(timestamp, 1_000_000)
+    result = cls.fromtimestamp(seconds, tz=tzinfo)
+    if microseconds:
+        return result.replace(microsecond=microseconds)
+    return result
+
+
+def datetime64_add_months(days, months):
+    import numpy as np
+
+    month = days.astype('M8[M]')
+    day = days - month.astype('M8[D]')
+
+    # clip day to month
+    month = month + np.asarray(months).astype('m8[M]')
+    first = month.astype('M8[D]')
+    last = (month + np.timedelta64(1, 'M')).astype('M8[D]') - np.timedelta64(1, 'D')
+    return np.minimum(first + day, last)
+
+
+def datetime64_add(array, delta):
+    # datetime64 values carry no timezone, so they are treated like UTC.
+    # The components of delta may also be arrays (see NominalDeltaArray).
+    import numpy as np
+
+    array = np.asarray(array)
+    if array.dtype.kind != 'M':
+        raise TypeError('Unsupported types')
+    unit, _ = np.datetime_data(array.dtype)
+
+    days = array.astype('M8[D]')
+    result = datetime64_add_months(days, delta.months)
+    result = result + np.asarray(delta.days).astype('m8[D]')
+
+    if unit in ['Y', 'M', 'W', 'D']:
+        return result
+    microseconds = np.asarray(_microseconds(delta))
+    seconds, rest = divmod(microseconds, 1_000_000)
+    if rest.any():
+        return result + (array - days) + microseconds.astype('m8[us]')
+    # keep the unit of the input if there are no fractional seconds
+    return result + (array - days) + seconds.astype('m8[s]')
+
+
+def datetime64_diff(a, b, *, allow_months=True):
+    import numpy as np
+
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if a.dtype.kind != 'M' or b.dtype.kind != 'M':
+        raise TypeError('Unsupported types')
+    if np.isnat(a).any() or np.isnat(b).any():
+        raise ValueError('NaT is not supported')
+
+    swap = a > b
+    lower = np.where(swap, b, a)
+    upper = np.where(swap, a, b)
+    unit, _ = np.datetime_data(lower.dtype)
+
+    lower_days = lower.astype('M8[D]')
+    upper_days = upper.astype('M8[D]')
+    lower_time = lower - lower_days
+    upper_time = upper - upper_days
+
+    if allow_months:
+        months = upper_days.astype('M8[M]') - lower_days.astype('M8[M]')
+        months = months.astype(np.int64)
+        overshoot = datetime64_add_months(lower_days, months) + lower_time > upper
+        months -= overshoot
+        base = datetime64_add_months(lower_days, months)
+    else:
+        months = np.zeros(swap.shape, dtype=np.int64)
+        base = lower_days
+    days = (upper_days - base).astype(np.int64)
+
+    if unit in ['Y', 'M', 'W', 'D']:
+        seconds = np.zeros(swap.shape)
+    else:
+        time = upper_time - lower_time
+        borrow = time < np.timedelta64(0, 's')
+        days -= borrow
+        time = time + np.where(borrow, np.timedelta64(1, 'D'), np.timedelta64(0, 'D'))
+        seconds = time / np.timedelta64(1, 's')
+
+    return (
+        np.where(swap, -months, months),
+        np.where(swap, -days, days),
+        np.where(swap, -seconds, seconds),
     )
 
 
+def _count(key, n=1):
+    # callers check _counting first so the hot paths stay cheap, but the
+    # active context may belong to another thread
+    counters = _counters.get()
+    if counters is not None:
+        with _counters_lock:
+            counters[key] += n
+
+
+@contextmanager
+def counting():
+    # count work done on the hot paths while the context is active; the
+    # counts of nested contexts are added to the outer ones on exit
+    global _counting
+    outer = _counters.get()
+    counters = dict.fromkeys(COUNTERS, 0)
+    token = _counters.set(counters)
+    with _counters_lock:
+        _counting += 1
+    try:
+        yield counters
+    finally:
+        _counters.reset(token)
+        with _counters_lock:
+            _counting -= 1
+            if outer is not None:
+                for key, value in counters.items():
+                    outer[key] += value
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def __call__(self, key, func, *args):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+        # compute outside of the lock so other threads are not blocked
+        value = func(*args)
+        with self.lock:
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def info(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def enable_cache(maxsize: int = 1024) -> LRUCache:
+    # memoize diff() on plain dates for the whole process
+    global _cache
+    _cache = LRUCache(maxsize)
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+
+@contextmanager
+def caching(maxsize: int = 1024):
+    # memoize diff() on plain dates while the context is active. This is a
+    # context variable, so other threads and tasks are not affected.
+    cache = LRUCache(maxsize)
+    token = _context_cache.set(cache)
+    try:
+        yield cache
+    finally:
+        _context_cache.reset(token)
+
+
 def binary_search(a, b, delta):
+    probes = 1
     upper = 1
     while a + delta * upper <= b:
         upper <<= 1
+        probes += 1
     lower = upper >> 1
     while lower + 1 < upper:
+        probes += 1
         tmp = (lower + upper) // 2
         if a + delta * tmp <= b:
             lower = tmp
         else:
             upper = tmp
+    if _counting:
+        _count('binary_search_probes', probes)
     return lower * delta
 
 
+def month_search(a, b, delta):
+    # same result as binary_search(a, b, delta) for a one month delta, but
+    # the count is read off the calendar fields and only corrected for
+    # clipping and DST afterwards
+    other = b
+    if (
+        isinstance(a, datetime)
+        and a.tzinfo is not b.tzinfo
+        and a.tzinfo is not None
+        and b.tzinfo is not None
+    ):
+        other = b.astimezone(a.tzinfo)
+    months = max(0, other.year * 12 + other.month - a.year * 12 - a.month)
+    probes = 0
+    while months > 0 and not a + delta * months <= b:
+        months -= 1
+        probes += 1
+    if months > 0:
+        probes += 1
+    if other is not b:
+        # wall clock and absolute order may disagree in different zones
+        probes += 1
+        while a + delta * (months + 1) <= b:
+            months += 1
+            probes += 1
+    if _counting:
+        _count('month_search_probes', probes)
+    return months * delta
+
+
+def estimate(a, b, delta):
+    # rough number of steps from a to b, only used as a starting point
+    if isinstance(b, date) and delta.months and not (delta.days or delta.seconds):
+        return ((b.year - a.year) * 12 + b.month - a.month) // delta.months
+    average = delta.months * 30.436875 + delta.days
+    if isinstance(a, datetime):
+        average += delta.seconds / 86400
+    if not average:
+        return 0
+    return int((b - a) / timedelta(days=1) / average)
+
+
+def search(pred, guess=0):
+    # smallest k >= 0 for which pred(k) is false, assuming pred is monotonic
+    guess = max(guess, 0)
+    step = 1
+    if pred(guess):
+        lower = guess
+        while pred(lower + step):
+            lower += step
+            step <<= 1
+        upper = lower + step
+    else:
+        upper = guess
+        while upper > 0 and not pred(max(upper - step, 0)):
+            upper = max(upper - step, 0)
+            step <<= 1
+        if upper == 0:
+            return 0
+        lower = max(upper - step, 0)
+    while lower + 1 < upper:
+        tmp = (lower + upper) // 2
+        if pred(tmp):
+            lower = tmp
+        else:
+            upper = tmp
+    return upper
+
+
 class NominalDelta:
-    def __init__(
-        self: Self,
+    # seconds are stored as exact integer microseconds
+    __slots__ = ['_microseconds', 'days', 'months']
+
+    def __new__(
+        cls: type[Self],
         *,
         years: int = 0,
         months: int = 0,
@@ -58,14 +424,69 @@ class NominalDelta:
         hours: int = 0,
         minutes: int = 0,
         seconds: float = 0,
-    ):
-        for key in ['years', 'months', 'weeks', 'days', 'hours', 'minutes']:
-            if not isinstance(locals()[key], int):
-                raise ValueError(f'{key} must be an int')
+    ) -> Self:
+        if not (
+            isinstance(years, int)
+            and isinstance(months, int)
+            and isinstance(weeks, int)
+            and isinstance(days, int)
+            and isinstance(hours, int)
+            and isinstance(minutes, int)
+        ):
+            for key, value in [
+                ('years', years),
+                ('months', months),
+                ('weeks', weeks),
+                ('days', days),
+                ('hours', hours),
+                ('minutes', minutes),
+            ]:
+                if not isinstance(value, int):
+                    raise ValueError(f'{key} must be an int')
+
+        return cls._new(
+            years * 12 + months,
+            weeks * 7 + days,
+            hours * 3600 + minutes * 60 + seconds,
+        )
+
+    @classmethod
+    def _new(cls, months: int, days: int, seconds: float) -> 'NominalDelta':
+        # unchecked constructor for values that are already normalized
+        if seconds.__class__ is int:
+            return cls._new_us(months, days, seconds * 1_000_000)
+        # round to microseconds like timedelta()
+        return cls._new_us(months, days, round(seconds * 1_000_000))
+
+    @classmethod
+    def _new_us(cls, months: int, days: int, microseconds: int) -> 'NominalDelta':
+        # only whole minutes are interned
+        if cls is NominalDelta and not microseconds % 60_000_000:
+            self = _interned.get((months, days, microseconds))
+            if self is not None:
+                return self
+        self = object.__new__(cls)
+        _set_months(self, months)
+        _set_days(self, days)
+        _set_microseconds(self, microseconds)
+        return self
 
-        self.months = years * 12 + months
-        self.days = weeks * 7 + days
-        self.seconds = hours * 3600 + minutes * 60 + seconds
+    @property
+    def seconds(self) -> float:
+        # int if there are no fractional seconds, float otherwise
+        seconds, rest = divmod(self._microseconds, 1_000_000)
+        if rest:
+            return self._microseconds / 1_000_000
+        return seconds
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __reduce__(self):
+        return (self._new_us, (self.months, self.days, self._microseconds))
 
     def __repr__(self):
         return (
@@ -74,47 +495,47 @@ class NominalDelta:
         )
 
     def __hash__(self):
-        return hash((self.months, self.days, self.seconds))
+        return hash((self.months, self.days, self._microseconds))
 
     def __bool__(self) -> bool:
-        return bool(self.months or self.days or self.seconds)
+        return bool(self.months or self.days or self._microseconds)
 
     def __eq__(self, other) -> bool:
         if isinstance(other, NominalDelta):
             return (
                 self.months == other.months
                 and self.days == other.days
-                and self.seconds == other.seconds
+                and self._microseconds == other._microseconds
             )
         return NotImplemented
 
     def __add__(self: Self, other) -> Self:
         if isinstance(other, NominalDelta):
-            return self.__class__(
-                months=self.months + other.months,
-                days=self.days + other.days,
-                seconds=self.seconds + other.seconds,
+            return self._new_us(
+                self.months + other.months,
+                self.days + other.days,
+                self._microseconds + other._microseconds,
             )
         return NotImplemented
 
     def __sub__(self: Self, other) -> Self:
         if isinstance(other, NominalDelta):
-            return self.__class__(
-                months=self.months - other.months,
-                days=self.days - other.days,
-                seconds=self.seconds - other.seconds,
+            return self._new_us(
+                self.months - other.months,
+                self.days - other.days,
+                self._microseconds - other._microseconds,
             )
         return NotImplemented
 
     def __neg__(self: Self) -> Self:
-        return self.__class__() - self
+        return self._new_us(-self.months, -self.days, -self._microseconds)
 
     def __mul__(self: Self, factor: int) -> Self:
         if isinstance(factor, int):
-            return self.__class__(
-                months=self.months * factor,
-                days=self.days * factor,
-                seconds=self.seconds * factor,
+            return self._new_us(
+                self.months * factor,
+                self.days * factor,
+                self._microseconds * factor,
             )
         return NotImplemented
 
@@ -131,20 +552,1131 @@ class NominalDelta:
     def __rsub__(self: Self, other: Date) -> Date:
         return (-self).__radd__(other)
 
+    def add_to(self, array):
+        return datetime64_add(array, self)
+
     @classmethod
     def diff(cls: type[Self], a: Date, b: Date, *, allow_months: bool = True) -> Self:
         if isinstance(a, date) and isinstance(b, date):
-            if a > b:
-                return -cls.diff(b, a)
-            delta = cls()
-            if allow_months:
-                delta += binary_search(a, b, cls(months=1))
-            delta += cls(days=b.toordinal() - (a + delta).toordinal())
-            if isinstance(a, datetime) and isinstance(b, datetime):
-                seconds = b.timestamp() - (a + delta).timestamp()
-                if seconds < 0:
-                    delta -= cls(days=1)
-                    seconds = b.timestamp() - (a + delta).timestamp()
-                delta += cls(seconds=seconds)
-            return delta
+            cache = _context_cache.get()
+            if cache is None:
+                # read the global once, another thread may disable the cache
+                cache = _cache
+            if cache is not None and a.__class__ is date and b.__class__ is date:
+                key = (cls, a.toordinal(), b.toordinal(), allow_months)
+                return cache(key, cls._diff, a, b, allow_months)
+            if (
+                a.__class__ is datetime
+                and b.__class__ is datetime
+                and a.tzinfo is b.tzinfo
+            ):
+                if a > b:
+                    return -cls._diff_datetime(b, a, allow_months)
+                return cls._diff_datetime(a, b, allow_months)
+            return cls._diff(a, b, allow_months)
         raise TypeError('Unsupported types')
+
+    @classmethod
+    def _diff_datetime(
+        cls, a: datetime, b: datetime, allow_months: bool
+    ) -> 'NominalDelta':
+        # Same result as _diff() for a <= b in the same timezone, but the
+        # candidates are built from the wall clock fields. Only the month
+        # candidate is normalized like dt_add() does, because gaps can move
+        # it. Everything after that only needs timestamp().
+        tzinfo = a.tzinfo
+        fixed = tzinfo.__class__ is timezone
+        months = 0
+        if allow_months:
+            months = max(0, b.year * 12 + b.month - a.year * 12 - a.month)
+        probes = 0
+        while True:
+            year, month = divmod(a.year * 12 + a.month - 1 + months, 12)
+            month += 1
+            day = a.day
+            if day > 28:
+                days_in_month = DAYS_IN_MONTH[month - 1]
+                if month == 2 and is_leap(year):
+                    days_in_month += 1
+                if day > days_in_month:
+                    day = days_in_month
+                    if _counting:
+                        _count('date_add_clips')
+            base = a.replace(year=year, month=month, day=day)
+            if fixed:
+                normalized = base
+            else:
+                if _counting:
+                    _count('dt_add_round_trips')
+                if base.microsecond:
+                    timestamp = _timestamp_us(base)
+                    normalized = _fromtimestamp_us(datetime, timestamp, tzinfo)
+                else:
+                    # whole seconds survive the float round trip
+                    normalized = datetime.fromtimestamp(base.timestamp(), tzinfo)
+            if months == 0:
+                break
+            probes += 1
+            if normalized <= b:
+                break
+            months -= 1
+        if allow_months and _counting:
+            _count('month_search_probes', probes)
+
+        days = b.toordinal() - normalized.toordinal()
+        end = _timestamp_us(b)
+        ordinal = base.toordinal() + days
+        time = a.timetz()
+        tmp = datetime.combine(date.fromordinal(ordinal), time)
+        microseconds = end - _timestamp_us(tmp)
+        if microseconds < 0:
+            if _counting:
+                _count('diff_corrections')
+            days -= 1
+            tmp = datetime.combine(date.fromordinal(ordinal - 1), time)
+            microseconds = end - _timestamp_us(tmp)
+        return cls._new_us(months, days, microseconds)
+
+    @classmethod
+    def _diff(cls, a: Date, b: Date, allow_months: bool) -> 'NominalDelta':
+        if a > b:
+            return -cls._diff(b, a, allow_months)
+        months = 0
+        if allow_months:
+            months = month_search(a, b, cls._new(1, 0, 0)).months
+        days = b.toordinal() - (a + cls._new(months, 0, 0)).toordinal()
+        microseconds = 0
+        if isinstance(a, datetime) and isinstance(b, datetime):
+            end = _timestamp_us(b)
+            microseconds = end - _timestamp_us(a + cls._new(months, days, 0))
+            if microseconds < 0:
+                if _counting:
+                    _count('diff_corrections')
+                days -= 1
+                microseconds = end - _timestamp_us(a + cls._new(months, days, 0))
+        return cls._new_us(months, days, microseconds)
+
+    @classmethod
+    def diff_from(cls, anchor: Date, values, *, allow_months: bool = True):
+        # same as diff(x, anchor) for each x, but for dates everything that
+        # only depends on anchor is calculated once (datetimes are handled by
+        # _diff_datetime(), which does not gain from this)
+        if not isinstance(anchor, date):
+            raise TypeError('Unsupported types')
+        anchor_month = anchor.year * 12 + anchor.month
+        anchor_ordinal = anchor.toordinal()
+        new = cls._new
+
+        for x in values:
+            if x.__class__ is not date or anchor.__class__ is not date:
+                yield cls.diff(x, anchor, allow_months=allow_months)
+                continue
+
+            # the steps of _diff() with anchor on either side
+            if x > anchor:
+                a = anchor
+                b_month = x.year * 12 + x.month
+                b_ordinal = x.toordinal()
+                a_month = anchor_month
+            else:
+                a = x
+                b_month = anchor_month
+                b_ordinal = anchor_ordinal
+                a_month = x.year * 12 + x.month
+            b = anchor if a is x else x
+
+            # month_search() keeping the base
+            months = max(0, b_month - a_month) if allow_months else 0
+            probes = 0
+            while months > 0:
+                base = a + new(months, 0, 0)
+                probes += 1
+                if not base > b:
+                    break
+                months -= 1
+            else:
+                base = a
+            if allow_months and _counting:
+                _count('month_search_probes', probes)
+            days = b_ordinal - base.toordinal()
+
+            if a is x:
+                yield new(months, days, 0)
+            else:
+                yield new(-months, -days, 0)
+
+    @staticmethod
+    def range(start: Date, stop: Date, step: 'NominalDelta') -> 'NominalRange':
+        return NominalRange(start, stop, step)
+
+    @classmethod
+    def diff_many(cls, a, b, *, allow_months: bool = True):
+        return datetime64_diff(a, b, allow_months=allow_months)
+
+    def _bucket(self, x: Date, anchor: Date, guess: int) -> int:
+        # largest k so that anchor + self * k is not after x (ascending only)
+        if anchor + self * guess <= x and not anchor + self * (guess + 1) <= x:
+            return guess
+        if x >= anchor:
+            return search(lambda k: anchor + self * k <= x, guess + 1) - 1
+        return -search(lambda k: anchor - self * k > x, -guess)
+
+    def bucket_index(self, x: Date, anchor: Date) -> int:
+        if _check_step(anchor, self):
+            return self._bucket(x, anchor, estimate(anchor, x, self))
+        return -(-self)._bucket(x, anchor, estimate(anchor, x, -self))
+
+    def bucket_many(self, values, anchor: Date):
+        # each search starts from the previous index, so sorted input is fast
+        sign = 1 if _check_step(anchor, self) else -1
+        step = self * sign
+        k = None
+        for x in values:
+            if k is None:
+                k = estimate(anchor, x, step)
+            k = step._bucket(x, anchor, k)
+            yield k * sign
+
+    def floor(self, x: Date, anchor: Date) -> Date:
+        # latest item of the grid anchor + self * k that is not after x
+        return anchor + self * self.bucket_index(x, anchor)
+
+    def ceil(self, x: Date, anchor: Date) -> Date:
+        # earliest item of the grid anchor + self * k that is not before x
+        k = self.bucket_index(x, anchor)
+        result = anchor + self * k
+        if result == x:
+            return result
+        return anchor + self * (k + 1 if _check_step(anchor, self) else k - 1)
+
+    @classmethod
+    def fromisoformat(cls, s: str) -> 'NominalDelta':
+        match = _ISO_DURATION.fullmatch(s)
+        if match is None:
+            raise ValueError(f'Invalid isoformat string: {s!r}')
+        return cls._fromisomatch(*match.groups())
+
+    @classmethod
+    def _fromisomatch(cls, sign, years, months, weeks, days, hours, minutes, seconds):
+        if seconds is None:
+            microseconds = 0
+        elif '.' in seconds or ',' in seconds:
+            from decimal import Decimal
+
+            # parse the decimal exactly instead of going through a float
+            seconds = Decimal(seconds.replace(',', '.')) * 1_000_000
+            microseconds = int(seconds.to_integral_value())
+        else:
+            microseconds = int(seconds) * 1_000_000
+        if hours is not None:
+            microseconds += int(hours) * 3_600_000_000
+        if minutes is not None:
+            microseconds += int(minutes) * 60_000_000
+        months = int(years or 0) * 12 + int(months or 0)
+        days = int(weeks or 0) * 7 + int(days or 0)
+        if sign == '-':
+            return cls._new_us(-months, -days, -microseconds)
+        return cls._new_us(months, days, microseconds)
+
+    @classmethod
+    def parse_many(cls, lines):
+        # deltas are immutable, so repeated strings can share one object
+        fullmatch = _ISO_DURATION.fullmatch
+        fromisomatch = cls._fromisomatch
+        seen = {}
+        for line in lines:
+            delta = seen.get(line)
+            if delta is None:
+                match = fullmatch(line.strip())
+                if match is None:
+                    raise ValueError(f'Invalid isoformat string: {line!r}')
+                delta = fromisomatch(*match.groups())
+                if len(seen) < 1024:
+                    seen[line] = delta
+            yield delta
+
+    def isoformat(self) -> str:
+        months, days, microseconds = self.months, self.days, self._microseconds
+        sign = ''
+        if months <= 0 and days <= 0 and microseconds <= 0 and self:
+            sign = '-'
+            months, days, microseconds = -months, -days, -microseconds
+
+        s = ''
+        if months:
+            y, m = divmod(abs(months), 12)
+            prefix = '-' if months < 0 else ''
+            if y:
+                s += f'{prefix}{y}Y'
+            if m:
+                s += f'{prefix}{m}M'
+        if days:
+            s += f'{days}D'
+
+        t = ''
+        prefix = '-' if microseconds < 0 else ''
+        seconds, fraction = divmod(abs(microseconds), 1_000_000)
+        if fraction:
+            fraction = f'{fraction:06d}'.rstrip('0')
+            t += f'{prefix}{seconds}.{fraction}S'
+        else:
+            h, rest = divmod(seconds, 3600)
+            m, sec = divmod(rest, 60)
+            if h:
+                t += f'{prefix}{h}H'
+            if m:
+                t += f'{prefix}{m}M'
+            if sec:
+                t += f'{prefix}{sec}S'
+        if t or not s:
+            s += f'T{t or "0S"}'
+        return f'{sign}P{s}'
+
+
+# NominalDelta is immutable, so slots are set through their descriptors
+_set_months = NominalDelta.months.__set__
+_set_days = NominalDelta.days.__set__
+_set_microseconds = NominalDelta._microseconds.__set__
+
+# common small deltas are shared instead of allocated on every operation
+_interned = {}
+_interned.update(
+    (key, NominalDelta._new_us(*key))
+    for i in range(-100, 101)
+    for key in [
+        (i, 0, 0),
+        (0, i, 0),
+        (0, 0, i * 60_000_000),
+        (0, 0, i * 3_600_000_000),
+    ]
+)
+
+
+def _check_step(start: Date, step: NominalDelta) -> bool:
+    # returns whether the steps are ascending
+    if not isinstance(step, NominalDelta):
+        raise TypeError('step must be a NominalDelta')
+    components = [step.months, step.days, step.seconds]
+    if min(components) < 0 < max(components):
+        raise ValueError('step must not mix positive and negative values')
+    if step.months or step.days:
+        return step.months > 0 or step.days > 0
+    if isinstance(start, datetime) and timedelta(seconds=step.seconds):
+        return step.seconds > 0
+    raise ValueError('step must not be zero')
+
+
+class NominalRange(Sequence):
+    def __init__(self, start: Date, stop: Date, step: NominalDelta):
+        self._ascending = _check_step(start, step)
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self._indices = None
+        self._sliced = False
+
+    def __repr__(self):
+        s = f'NominalRange({self.start!r}, {self.stop!r}, {self.step!r})'
+        if self._sliced:
+            indices = self._indices
+            s += f'[{indices.start}:{indices.stop}:{indices.step}]'
+        return s
+
+    def _get(self, k: int) -> Date:
+        return self.start + self.step * k
+
+    def _before(self, a: Date, b: Date) -> bool:
+        return a < b if self._ascending else a > b
+
+    def _find(self, x: Date) -> int:
+        # smallest k so that the k-th item is not before x
+        guess = estimate(self.start, x, self.step)
+        return search(lambda k: self._before(self._get(k), x), guess)
+
+    @property
+    def indices(self) -> range:
+        if self._indices is None:
+            self._indices = range(self._find(self.stop))
+        return self._indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __iter__(self):
+        if self._indices is None:
+            k = 0
+            while self._before(item := self._get(k), self.stop):
+                yield item
+                k += 1
+        else:
+            for k in self._indices:
+                yield self._get(k)
+
+    def __reversed__(self):
+        for k in reversed(self.indices):
+            yield self._get(k)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            result = self.__class__.__new__(self.__class__)
+            result.__dict__.update(self.__dict__)
+            result._indices = self.indices[i]
+            result._sliced = True
+            return result
+        return self._get(self.indices[i])
+
+    def index(self, x: Date) -> int:
+        try:
+            k = self._find(x)
+        except TypeError:
+            raise ValueError(f'{x!r} is not in range') from None
+        if k in self.indices and self._get(k) == x:
+            return self.indices.index(k)
+        raise ValueError(f'{x!r} is not in range')
+
+    def __contains__(self, x) -> bool:
+        try:
+            self.index(x)
+        except ValueError:
+            return False
+        return True
+
+    def count(self, x) -> int:
+        return int(x in self)
+
+
+class Schedule:
+    # Merges many recurrences anchor + step * k into one ordered stream. The
+    # heap holds one entry per rule, so memory does not grow with the horizon.
+    def __init__(self, rules=()):
+        self._rules = []
+        for rule in rules:
+            self.add(*rule)
+
+    def __repr__(self):
+        return f'<Schedule with {len(self._rules)} rules>'
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def add(self, anchor: Date, step: NominalDelta, end=None, count=None) -> int:
+        # returns the rule index that is yielded with each occurrence
+        if not _check_step(anchor, step):
+            raise ValueError('step must be positive')
+        if count is not None and count < 0:
+            raise ValueError('count must not be negative')
+        # resolve the type dispatch of anchor + step once per rule
+        add = dt_add if isinstance(anchor, datetime) else date_add
+        self._rules.append((anchor, step, end, count, add))
+        return len(self._rules) - 1
+
+    def __iter__(self):
+        return self.occurrences()
+
+    def occurrences(self, start=None, stop=None):
+        # yields (occurrence, rule index) pairs with start <= occurrence < stop
+        heap = []
+        for i, (anchor, step, end, count, add) in enumerate(self._rules):
+            k = 0
+            if start is not None and start > anchor:
+                # skip ahead instead of generating earlier occurrences
+                k = step.bucket_index(start, anchor)
+                if anchor + step * k < start:
+                    k += 1
+            if count is not None and k >= count:
+                continue
+            item = anchor + step * k
+            if end is None or item < end:
+                heap.append((item, i, k))
+        heapify(heap)
+
+        rules = self._rules
+        while heap:
+            item, i, k = heap[0]
+            if stop is not None and not item < stop:
+                return
+            yield item, i
+            anchor, step, end, count, add = rules[i]
+            k += 1
+            if count is None or k < count:
+                item = add(anchor, step * k)
+                if end is None or item < end:
+                    heapreplace(heap, (item, i, k))
+                    continue
+            heappop(heap)
+
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:  # python < 3.10
+
+    def _popcount(x: int) -> int:
+        return bin(x).count('1')
+
+
+class BusinessCalendar:
+    # One bit per day in [start, end) plus the number of business days
+    # before each 64 bit word, so rank and select take one lookup each.
+    def __init__(self, start: date, end: date, *, holidays=(), weekdays=range(5)):
+        if not start < end:
+            raise ValueError('start must be before end')
+        self.start = start
+        self.end = end
+        self._first = start.toordinal()
+        self._size = end.toordinal() - self._first
+
+        weekdays = set(weekdays)
+        holidays = {d.toordinal() for d in holidays}
+        words = array('Q', bytes(8 * ((self._size >> 6) + 1)))
+        for i in range(self._size):
+            ordinal = self._first + i
+            if (ordinal + 6) % 7 in weekdays and ordinal not in holidays:
+                words[i >> 6] |= 1 << (i & 63)
+        ranks = array('L', [0])
+        for word in words:
+            ranks.append(ranks[-1] + _popcount(word))
+        self._words = words
+        self._ranks = ranks
+
+    def __repr__(self):
+        return f'BusinessCalendar({self.start!r}, {self.end!r})'
+
+    def _index(self, d: date) -> int:
+        i = d.toordinal() - self._first
+        if not 0 <= i <= self._size:
+            raise ValueError(f'{d!r} is outside of the calendar')
+        return i
+
+    def _rank(self, i: int) -> int:
+        # number of business days before the i-th day
+        word = self._words[i >> 6] & ((1 << (i & 63)) - 1)
+        return self._ranks[i >> 6] + _popcount(word)
+
+    def _select(self, rank: int) -> int:
+        # index of the business day with the given rank
+        if not 0 <= rank < self._ranks[-1]:
+            raise ValueError('result is outside of the calendar')
+        w = bisect_right(self._ranks, rank) - 1
+        word = self._words[w]
+        for _ in range(rank - self._ranks[w]):
+            word &= word - 1
+        return (w << 6) + (word & -word).bit_length() - 1
+
+    def is_business_day(self, d: date) -> bool:
+        i = self._index(d)
+        return i < self._size and bool(self._words[i >> 6] >> (i & 63) & 1)
+
+    def count(self, a: date, b: date) -> int:
+        # business days in [a, b)
+        return self._rank(self._index(b)) - self._rank(self._index(a))
+
+    def add(self, d: Date, delta: NominalDelta) -> Date:
+        # months are added like date_add(), then days count business days
+        # (starting from the next business day if that is not one)
+        if not isinstance(delta, NominalDelta):
+            raise TypeError('delta must be a NominalDelta')
+        day = d.date() if isinstance(d, datetime) else d
+        if delta.months:
+            day = date_add(day, NominalDelta._new(delta.months, 0, 0))
+        i = self._select(self._rank(self._index(day)) + delta.days)
+        day = date.fromordinal(self._first + i)
+        if isinstance(d, datetime):
+            tmp = d.__class__.combine(day, d.timetz())
+            return dt_add(tmp, NominalDelta._new_us(0, 0, delta._microseconds))
+        return d.__class__.fromordinal(day.toordinal())
+
+    def diff(self, a: date, b: date, *, allow_months: bool = True) -> NominalDelta:
+        if a.__class__ is not date or b.__class__ is not date:
+            raise TypeError('Unsupported types')
+        if a > b:
+            return -self.diff(b, a, allow_months=allow_months)
+        months = 0
+        if allow_months:
+            months = month_search(a, b, NominalDelta._new(1, 0, 0)).months
+        base = date_add(a, NominalDelta._new(months, 0, 0))
+        return NominalDelta._new(months, self.count(base, b), 0)
+
+
+class NominalDeltaArray:
+    # columnar storage for many NominalDelta values (requires numpy). Like
+    # NominalDelta, seconds are stored as exact integer microseconds.
+    __array_ufunc__ = None
+
+    def __init__(self, months=0, days=0, seconds=0):
+        import numpy as np
+
+        months, days, seconds = np.broadcast_arrays(
+            _to_int64(months, 'months'),
+            _to_int64(days, 'days'),
+            np.asarray(seconds),
+        )
+        self.months = np.array(months, ndmin=1)
+        self.days = np.array(days, ndmin=1)
+        self.microseconds = np.array(_to_microseconds(seconds), ndmin=1)
+
+    @classmethod
+    def _new(cls, months, days, microseconds):
+        # unchecked constructor that keeps the given arrays (no copy)
+        self = object.__new__(cls)
+        self.months = months
+        self.days = days
+        self.microseconds = microseconds
+        return self
+
+    @classmethod
+    def from_deltas(cls, deltas):
+        import numpy as np
+
+        deltas = list(deltas)
+        return cls._new(
+            np.array([delta.months for delta in deltas], dtype=np.int64),
+            np.array([delta.days for delta in deltas], dtype=np.int64),
+            np.array([delta._microseconds for delta in deltas], dtype=np.int64),
+        )
+
+    @property
+    def seconds(self):
+        # int64 if there are no fractional seconds, float64 otherwise
+        seconds, rest = divmod(self.microseconds, 1_000_000)
+        if rest.any():
+            return self.microseconds / 1_000_000
+        return seconds
+
+    def tolist(self) -> list:
+        return [
+            NominalDelta._new_us(*item)
+            for item in zip(
+                self.months.tolist(), self.days.tolist(), self.microseconds.tolist()
+            )
+        ]
+
+    def __repr__(self):
+        return (
+            f'NominalDeltaArray(months={self.months.tolist()}, '
+            f'days={self.days.tolist()}, seconds={self.seconds.tolist()})'
+        )
+
+    def __len__(self) -> int:
+        return len(self.months)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        try:
+            i = operator.index(i)
+        except TypeError:
+            return self._new(self.months[i], self.days[i], self.microseconds[i])
+        return NominalDelta._new_us(
+            self.months[i].item(), self.days[i].item(), self.microseconds[i].item()
+        )
+
+    __hash__ = None
+
+    def __eq__(self, other):
+        if isinstance(other, (NominalDelta, NominalDeltaArray)):
+            return (
+                (self.months == other.months)
+                & (self.days == other.days)
+                & (self.microseconds == _microseconds(other))
+            )
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return ~result
+
+    def __add__(self, other):
+        if isinstance(other, (NominalDelta, NominalDeltaArray)):
+            return self._new(
+                self.months + other.months,
+                self.days + other.days,
+                self.microseconds + _microseconds(other),
+            )
+        return NotImplemented
+
+    def __radd__(self, other):
+        if isinstance(other, NominalDelta):
+            return self + other
+        if getattr(other, 'dtype', None) is not None and other.dtype.kind == 'M':
+            return self.add_to(other)
+        return NotImplemented
+
+    def __sub__(self, other):
+        if isinstance(other, (NominalDelta, NominalDeltaArray)):
+            return self._new(
+                self.months - other.months,
+                self.days - other.days,
+                self.microseconds - _microseconds(other),
+            )
+        return NotImplemented
+
+    def __rsub__(self, other):
+        return (-self).__radd__(other)
+
+    def __neg__(self):
+        return self._new(-self.months, -self.days, -self.microseconds)
+
+    def __mul__(self, factor):
+        if isinstance(factor, int) or (
+            getattr(factor, 'dtype', None) is not None and factor.dtype.kind in 'iu'
+        ):
+            return self._new(
+                self.months * factor,
+                self.days * factor,
+                self.microseconds * factor,
+            )
+        return NotImplemented
+
+    def __rmul__(self, factor):
+        return self.__mul__(factor)
+
+    def sum(self) -> NominalDelta:
+        return NominalDelta._new_us(
+            self.months.sum().item(),
+            self.days.sum().item(),
+            self.microseconds.sum().item(),
+        )
+
+    def unique(self, *, return_inverse=False, return_counts=False):
+        # group equal deltas by sorting instead of hashing
+        import numpy as np
+
+        order = np.lexsort((self.microseconds, self.days, self.months))
+        months = self.months[order]
+        days = self.days[order]
+        microseconds = self.microseconds[order]
+        start = np.ones(len(order), dtype=bool)
+        start[1:] = (
+            (months[1:] != months[:-1])
+            | (days[1:] != days[:-1])
+            | (microseconds[1:] != microseconds[:-1])
+        )
+        result = [self._new(months[start], days[start], microseconds[start])]
+        if return_inverse:
+            inverse = np.empty(len(order), dtype=np.intp)
+            inverse[order] = np.cumsum(start) - 1
+            result.append(inverse)
+        if return_counts:
+            result.append(np.diff(np.append(np.flatnonzero(start), len(order))))
+        return result[0] if len(result) == 1 else tuple(result)
+
+    def add_to(self, array):
+        return datetime64_add(array, self)
+
+
+def _microseconds(delta):
+    # the seconds of a NominalDelta or NominalDeltaArray as microseconds
+    if isinstance(delta, NominalDelta):
+        return delta._microseconds
+    return delta.microseconds
+
+
+def _to_int64(value, key):
+    # like NominalDelta(), reject floats instead of truncating them
+    import numpy as np
+
+    value = np.asarray(value)
+    if value.dtype.kind not in 'iub' and value.size:
+        raise ValueError(f'{key} must be an int')
+    return value.astype(np.int64)
+
+
+def _to_microseconds(seconds):
+    # convert seconds to int64 microseconds, rounded like timedelta()
+    import numpy as np
+
+    seconds = np.asarray(seconds)
+    if seconds.dtype.kind in 'iub':
+        return seconds.astype(np.int64) * 1_000_000
+    if seconds.dtype.kind != 'f':
+        raise TypeError('seconds must be numeric')
+    return np.round(seconds * 1_000_000).astype(np.int64)
+
+
+_DELTA_DTYPE = [('months', '<i8'), ('days', '<i8'), ('microseconds', '<i8')]
+
+
+def _to_datetime64(values):
+    import numpy as np
+
+    values = list(values)
+    if all(isinstance(value, datetime) for value in values):
+        # aware datetimes are stored as UTC, naive ones as wall clock time
+        return np.array([
+            value if value.tzinfo is None else (
+                value.astimezone(timezone.utc).replace(tzinfo=None)
+            )
+            for value in values
+        ], dtype='<M8[us]')
+    if any(isinstance(value, datetime) for value in values):
+        raise TypeError('Cannot mix date and datetime')
+    return np.array(values, dtype='<M8[D]')
+
+
+def save(file, data):
+    # Writes a .npy file. Deltas are stored as records of little endian
+    # int64 months, days and microseconds. Dates are stored as
+    # datetime64[D] and datetimes as datetime64[us].
+    import numpy as np
+
+    if isinstance(data, NominalDeltaArray):
+        records = np.empty(len(data), dtype=_DELTA_DTYPE)
+        records['months'] = data.months
+        records['days'] = data.days
+        records['microseconds'] = data.microseconds
+    elif getattr(data, 'dtype', None) is not None:
+        if data.dtype.kind != 'M':
+            raise TypeError('Unsupported types')
+        records = data.astype(data.dtype.newbyteorder('<'), copy=False)
+    else:
+        data = list(data)
+        if data and all(isinstance(item, NominalDelta) for item in data):
+            return save(file, NominalDeltaArray.from_deltas(data))
+        records = _to_datetime64(data)
+    np.save(file, records, allow_pickle=False)
+
+
+def load(file, *, mmap=True):
+    # Returns a NominalDeltaArray or a datetime64 array. With mmap=True the
+    # arrays are read-only views into the file, so nothing is copied.
+    import numpy as np
+
+    records = np.load(file, mmap_mode='r' if mmap else None, allow_pickle=False)
+    if records.dtype.names == ('months', 'days', 'microseconds'):
+        return NominalDeltaArray._new(
+            records['months'], records['days'], records['microseconds']
+        )
+    if records.dtype.kind != 'M':
+        raise ValueError('Unsupported file')
+    return records
+
+
+def _encode(value):
+    # dates are sent as ordinals, datetimes as (ordinal, microseconds, tz, fold)
+    if isinstance(value, datetime):
+        tzinfo = value.tzinfo
+        if tzinfo is not None and tzinfo.__class__ is not timezone:
+            from zoneinfo import ZoneInfo
+
+            if isinstance(tzinfo, ZoneInfo) and tzinfo.key is not None:
+                tzinfo = tzinfo.key
+        return (
+            value.toordinal(),
+            ((value.hour * 60 + value.minute) * 60 + value.second) * 1_000_000
+            + value.microsecond,
+            tzinfo,
+            value.fold,
+        )
+    elif isinstance(value, date):
+        return value.toordinal()
+    raise TypeError('Unsupported types')
+
+
+def _decode(value, cls=None):
+    # cls restores the class of the original value, e.g. a subclass of date
+    if value.__class__ is int:
+        return (cls or date).fromordinal(value)
+    ordinal, microseconds, tzinfo, fold = value
+    if tzinfo.__class__ is str:
+        from zoneinfo import ZoneInfo
+
+        tzinfo = ZoneInfo(tzinfo)
+    d = date.fromordinal(ordinal)
+    seconds, microseconds = divmod(microseconds, 1_000_000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return (cls or datetime)(
+        d.year, d.month, d.day, hours, minutes, seconds, microseconds, tzinfo, fold=fold
+    )
+
+
+def _diff_chunk(chunk, allow_months):
+    result = []
+    for a, b in chunk:
+        delta = NominalDelta.diff(_decode(a), _decode(b), allow_months=allow_months)
+        result.append((delta.months, delta.days, delta._microseconds))
+    return result
+
+
+def _add_chunk(chunk, months, days, microseconds):
+    delta = NominalDelta._new_us(months, days, microseconds)
+    return [_encode(_decode(value) + delta) for value in chunk]
+
+
+def _map_diff_chunk(chunk, allow_months):
+    diff = NominalDelta.diff
+    return [diff(a, b, allow_months=allow_months) for a, b in chunk]
+
+
+def _map_add_chunk(chunk, delta):
+    return [value + delta for value in chunk]
+
+
+def _parallel(func, chunks, args, workers, threads=False):
+    # at most two chunks per worker are in flight, so memory stays bounded
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import ThreadPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    executor_class = ThreadPoolExecutor if threads else ProcessPoolExecutor
+    with executor_class(workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            if threads:
+                # run in a copy of the caller's context, so caching() and
+                # counting() apply to the workers
+                future = executor.submit(copy_context().run, func, chunk, *args)
+            else:
+                future = executor.submit(func, chunk, *args)
+            pending.append(future)
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _chunks(items, chunksize):
+    if chunksize < 1:
+        raise ValueError('chunksize must be positive')
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def diff_parallel(pairs, *, workers=None, chunksize=10_000, allow_months=True):
+    chunks = (
+        [(_encode(a), _encode(b)) for a, b in chunk]
+        for chunk in _chunks(pairs, chunksize)
+    )
+    new = NominalDelta._new_us
+    for result in _parallel(_diff_chunk, chunks, (allow_months,), workers):
+        for item in result:
+            yield new(*item)
+
+
+def add_parallel(values, delta, *, workers=None, chunksize=10_000):
+    if not isinstance(delta, NominalDelta):
+        raise TypeError('delta must be a NominalDelta')
+    # the classes stay in the parent so that subclasses are not lost
+    classes = deque()
+
+    def chunks():
+        for chunk in _chunks(values, chunksize):
+            classes.append([value.__class__ for value in chunk])
+            yield [_encode(value) for value in chunk]
+
+    args = (delta.months, delta.days, delta._microseconds)
+    for result in _parallel(_add_chunk, chunks(), args, workers):
+        for value, cls in zip(result, classes.popleft()):
+            yield _decode(value, cls)
+
+
+def map_diff(pairs, *, workers=None, chunksize=1000, allow_months=True):
+    # like diff_parallel(), but threads share memory so nothing is pickled
+    chunks = _chunks(pairs, chunksize)
+    args = (allow_months,)
+    for result in _parallel(_map_diff_chunk, chunks, args, workers, threads=True):
+        yield from result
+
+
+def map_add(values, delta, *, workers=None, chunksize=1000):
+    if not isinstance(delta, NominalDelta):
+        raise TypeError('delta must be a NominalDelta')
+    chunks = _chunks(values, chunksize)
+    args = (delta,)
+    for result in _parallel(_map_add_chunk, chunks, args, workers, threads=True):
+        yield from result
+
+
+def _parse_value(s: str, tzinfo):
+    if len(s) == 10:
+        return date.fromisoformat(s)
+    if s.endswith('Z'):
+        s = s[:-1] + '+00:00'
+    dt = datetime.fromisoformat(s)
+    if dt.tzinfo is None and tzinfo is not None:
+        dt = dt.replace(tzinfo=tzinfo)
+    return dt
+
+
+def _cli_chunk(rows, command, fmt, cols, output, delta, tz, allow_months, skip):
+    # Runs in worker processes, so all arguments are plain values. Returns
+    # the converted rows and (index in chunk, message) for each bad row. The
+    # chunk stops at the first bad row unless skip is set.
+    import json
+    from zoneinfo import ZoneInfo
+
+    tzinfo = ZoneInfo(tz) if tz else None
+    if delta is not None:
+        delta = NominalDelta._new_us(*delta)
+    empty = None if fmt == 'ndjson' else ''
+    result = []
+    errors = []
+    for i, row in enumerate(rows):
+        try:
+            if fmt == 'ndjson':
+                row = json.loads(row)
+            if command == 'add':
+                for col in cols:
+                    if row[col]:
+                        value = _parse_value(row[col], tzinfo)
+                        row[col] = (value + delta).isoformat()
+            elif row[cols[0]] and row[cols[1]]:
+                a = _parse_value(row[cols[0]], tzinfo)
+                b = _parse_value(row[cols[1]], tzinfo)
+                diff = NominalDelta.diff(a, b, allow_months=allow_months)
+                row[output] = diff.isoformat()
+            else:
+                row[output] = empty
+        except (ValueError, TypeError, KeyError, IndexError, OverflowError) as e:
+            errors.append((i, f'{e.__class__.__name__}: {e}'))
+            if skip:
+                continue
+            break
+        if fmt == 'ndjson':
+            row = json.dumps(row)
+        result.append(row)
+    return result, errors
+
+
+def main(argv=None):
+    # the CLI modules are imported here so that importing the library stays fast
+    import argparse
+    import csv
+    import json
+    import time
+    from zoneinfo import ZoneInfo
+
+    parser = argparse.ArgumentParser(
+        prog='python -m nominaldelta',
+        description='Read CSV or NDJSON rows from stdin and write them to stdout.',
+    )
+    parser.add_argument('command', choices=['add', 'diff'])
+    parser.add_argument(
+        '--col',
+        action='append',
+        help='column to process (add: the first column by default, diff: two columns)',
+    )
+    parser.add_argument('--delta', help='ISO 8601 duration to add, e.g. P1M')
+    parser.add_argument('--output', default='delta', help='column for diff results')
+    parser.add_argument('--no-months', action='store_true', help='diff without months')
+    parser.add_argument('--tz', help='timezone for values without offset')
+    parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunksize', type=int, default=10_000)
+    parser.add_argument(
+        '--errors',
+        choices=['fail', 'skip'],
+        default='fail',
+        help='stop at the first bad row (default) or skip bad rows',
+    )
+    args = parser.parse_args(argv)
+    if args.chunksize < 1:
+        parser.error('--chunksize must be positive')
+    if args.workers < 0:
+        parser.error('--workers must not be negative')
+
+    delta = None
+    if args.command == 'add':
+        if args.delta is None:
+            parser.error('add requires --delta')
+        try:
+            delta = NominalDelta.fromisoformat(args.delta)
+        except ValueError as e:
+            parser.error(str(e))
+        delta = (delta.months, delta.days, delta._microseconds)
+    elif not args.col or len(args.col) != 2:
+        parser.error('diff requires exactly two --col')
+    if args.tz:
+        try:
+            ZoneInfo(args.tz)
+        except (ValueError, KeyError):
+            parser.error(f'unknown timezone: {args.tz}')
+
+    start = time.perf_counter()
+    if args.format == 'csv':
+        reader = csv.reader(sys.stdin)
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        header = next(reader, None)
+        if header is None:
+            return _report(0, start)
+        names = args.col or header[:1]
+        for name in names:
+            if name not in header:
+                parser.error(f'unknown column: {name}')
+        cols = [header.index(name) for name in names]
+        output = len(header)
+        if args.command == 'diff':
+            header.append(args.output)
+            rows = (row + [''] for row in reader)
+        else:
+            rows = reader
+        writer.writerow(header)
+        write = writer.writerows
+    else:
+        rows = (line for line in sys.stdin if line.strip())
+        cols = args.col
+        if cols is None:
+            first = next(rows, None)
+            if first is None:
+                return _report(0, start)
+            cols = list(json.loads(first))[:1]
+            rows = itertools.chain([first], rows)
+        output = args.output
+
+        def write(lines):
+            sys.stdout.write(''.join(line + '\n' for line in lines))
+
+    chunk_args = (
+        args.command,
+        args.format,
+        cols,
+        output,
+        delta,
+        args.tz,
+        not args.no_months,
+        args.errors == 'skip',
+    )
+    chunks = _chunks(rows, args.chunksize)
+    if args.workers > 1:
+        results = _parallel(_cli_chunk, chunks, chunk_args, args.workers)
+    else:
+        results = (_cli_chunk(chunk, *chunk_args) for chunk in chunks)
+
+    count = 0
+    offset = 1  # row numbers start at 1 and do not include a CSV header
+    for result, errors in results:
+        write(result)
+        count += len(result)
+        for i, message in errors:
+            if args.errors == 'fail':
+                print(f'error: row {offset + i}: {message}', file=sys.stderr)
+                results.close()
+                return 1
+            print(f'skipped row {offset + i}: {message}', file=sys.stderr)
+        offset += args.chunksize
+    return _report(count, start)
+
+
+def _report(count, start):
+    import time
+
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed else 0
+    print(f'{count} rows in {elapsed:.2f}s ({rate:,.0f} rows/s)', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    # import by name so worker processes can find the helpers
+    from nominaldelta import main as _main
+
+    sys.exit(_main())
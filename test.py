@@ -1,10 +1,49 @@
+import contextvars
+import copy
+import io
+import itertools
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from unittest import mock
 
 from zoneinfo import ZoneInfo
 
+from nominaldelta import BusinessCalendar
+from nominaldelta import LRUCache
 from nominaldelta import NominalDelta
+from nominaldelta import NominalDeltaArray
+from nominaldelta import Schedule
+from nominaldelta import add_parallel
+from nominaldelta import binary_search
+from nominaldelta import caching
+from nominaldelta import counting
+from nominaldelta import date_add
+from nominaldelta import diff_parallel
+from nominaldelta import disable_cache
+from nominaldelta import enable_cache
+from nominaldelta import load
+from nominaldelta import main
+from nominaldelta import map_add
+from nominaldelta import map_diff
+from nominaldelta import month_search
+from nominaldelta import save
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+MONTH = NominalDelta(months=1)
 
 
 class NotAValueClass:
@@ -48,6 +87,41 @@ class GeneralTests(unittest.TestCase):
         except Exception:  # pragma: no cover
             self.fail('NominalDelta() failed to hash!')
 
+    def test_immutable(self):
+        delta = NominalDelta(months=1)
+        with self.assertRaises(AttributeError):
+            delta.months = 2
+        with self.assertRaises(AttributeError):
+            del delta.days
+        with self.assertRaises(AttributeError):
+            delta.foo = 1
+        self.assertEqual(NominalDelta(months=1), NominalDelta(months=1, days=0))
+
+    def test_pickle(self):
+        for delta in [
+            NominalDelta(months=1),
+            NominalDelta(months=1000, days=-3, seconds=1.5),
+        ]:
+            self.assertEqual(pickle.loads(pickle.dumps(delta)), delta)
+            self.assertEqual(copy.deepcopy(delta), delta)
+
+    def test_seconds_microseconds(self):
+        self.assertEqual(NominalDelta(seconds=0.1) * 10, NominalDelta(seconds=1))
+        total = NominalDelta()
+        for _ in range(10):
+            total += NominalDelta(seconds=0.1)
+        self.assertEqual(total, NominalDelta(seconds=1))
+        self.assertEqual(hash(total), hash(NominalDelta(seconds=1)))
+        self.assertEqual(NominalDelta(seconds=1.0000004), NominalDelta(seconds=1))
+        self.assertEqual(NominalDelta(seconds=-0.5).seconds, -0.5)
+        delta = NominalDelta(days=1, seconds=0.000001)
+        self.assertEqual(pickle.loads(pickle.dumps(delta)), delta)
+
+    def test_seconds_type(self):
+        self.assertIsInstance(NominalDelta(seconds=0.5).seconds, float)
+        self.assertIsInstance(NominalDelta(seconds=0).seconds, int)
+        self.assertIsInstance(NominalDelta(seconds=2.0).seconds, int)
+
     def test_boolean(self):
         self.assertFalse(NominalDelta(days=0))
         self.assertTrue(NominalDelta(days=1))
@@ -150,6 +224,7 @@ class DeltaArithmeticTests(unittest.TestCase):
         self.assertEqual(type(child - delta), type(child))
         self.assertEqual(type(-child), type(child))
         self.assertEqual(type(child * 5), type(child))
+        self.assertEqual(type(copy.copy(child)), type(child))
 
 
 class AdditionTests(unittest.TestCase):
@@ -187,6 +262,21 @@ class AdditionTests(unittest.TestCase):
         self.assertEqual(date(2000, 2, 28) + NominalDelta(years=1), date(2001, 2, 28))
         self.assertEqual(date(2000, 2, 29) + NominalDelta(years=1), date(2001, 2, 28))
 
+    def test_add_date_subclass(self):
+        class ChildDate(date):
+            pass
+
+        for delta in [NominalDelta(months=1), NominalDelta(months=1, days=1)]:
+            result = ChildDate(2021, 1, 31) + delta
+            self.assertEqual(type(result), ChildDate)
+            self.assertEqual(result, date(2021, 2, 28) + NominalDelta(days=delta.days))
+
+    def test_add_date_overflow(self):
+        with self.assertRaises(OverflowError):
+            date(9999, 12, 1) + NominalDelta(months=1, days=-100)
+        with self.assertRaises(OverflowError):
+            date(1, 1, 1) - NominalDelta(months=1)
+
     def test_sub_date(self):
         self.assertEqual(date(1970, 1, 30) - NominalDelta(days=5), date(1970, 1, 25))
         self.assertEqual(date(2021, 2, 27) - NominalDelta(months=1), date(2021, 1, 27))
@@ -245,6 +335,45 @@ class AdditionTests(unittest.TestCase):
             datetime(2009, 9, 3, 0, 30, 30, 500000),
         )
 
+    def test_add_datetime_precision(self):
+        tz = ZoneInfo('Europe/Berlin')
+        for tzinfo in [None, timezone.utc, tz]:
+            for dt in [
+                datetime(1, 1, 2, 0, 0, 0, 1, tzinfo=tzinfo),
+                datetime(1833, 5, 1, 12, 0, 0, 999_999, tzinfo=tzinfo),
+                datetime(2021, 3, 28, 0, 59, 59, 999_999, tzinfo=tzinfo),
+                datetime(2107, 5, 1, 12, 0, 0, 1, tzinfo=tzinfo),
+                datetime(9000, 1, 1, 0, 0, 0, 1, tzinfo=tzinfo),
+                datetime(9999, 12, 30, 0, 0, 0, 1, tzinfo=tzinfo),
+            ]:
+                result = dt + NominalDelta(seconds=0.000001)
+                self.assertEqual(result - dt, timedelta(microseconds=1))
+                result = dt + NominalDelta(days=1, seconds=3600.000001)
+                self.assertEqual(result.microsecond, (dt.microsecond + 1) % 1_000_000)
+                self.assertEqual(
+                    NominalDelta.diff(dt, result),
+                    NominalDelta(days=1, seconds=3600.000001),
+                )
+
+    def test_add_datetime_fixed_offset(self):
+        tz = timezone(timedelta(hours=-5))
+        self.assertEqual(
+            datetime(2019, 3, 30, 2, 30, tzinfo=tz) + NominalDelta(days=1, hours=1),
+            datetime(2019, 3, 31, 3, 30, tzinfo=tz),
+        )
+        self.assertEqual(
+            datetime(2019, 1, 31, 23, 30, tzinfo=tz)
+            + NominalDelta(months=1, seconds=1800.5),
+            datetime(2019, 3, 1, 0, 0, 0, 500_000, tzinfo=tz),
+        )
+        result = datetime(2019, 10, 27, 2, 30, fold=1, tzinfo=tz) + NominalDelta()
+        self.assertEqual(result.fold, 0)
+        self.assertIs(result.tzinfo, tz)
+        self.assertEqual(
+            datetime(9999, 12, 31, 23, tzinfo=tz) + NominalDelta(minutes=30),
+            datetime(9999, 12, 31, 23, 30, tzinfo=tz),
+        )
+
     def test_add_datetime_dst_minutes(self):
         tz = ZoneInfo('Europe/Berlin')
         self.assertEqual(
@@ -402,6 +531,94 @@ class DiffTests(unittest.TestCase):
             NominalDelta(months=-1, seconds=-1),
         )
 
+    def test_diff_datetime_differential(self):
+        # diff() of two datetimes in the same zone has its own implementation
+        # that must agree with the generic one
+        rng = random.Random(0)
+        zones = [
+            None,
+            timezone.utc,
+            timezone(timedelta(hours=-3, minutes=-30)),
+            ZoneInfo('Europe/Berlin'),
+            ZoneInfo('America/Santiago'),
+            ZoneInfo('Australia/Lord_Howe'),
+            ZoneInfo('Pacific/Apia'),
+            ZoneInfo('America/Havana'),
+        ]
+
+        def random_datetime(tz):
+            year = rng.randint(1900, 2100)
+            month = rng.randint(1, 12)
+            day = rng.choice([1, 28, 29, 30, 31, rng.randint(1, 31)])
+            day = min(day, 29 if month == 2 else 30 if month in [4, 6, 9, 11] else 31)
+            if month == 2 and day == 29 and year % 4:
+                day = 28
+            return datetime(
+                year,
+                month,
+                day,
+                rng.choice([0, 1, 2, 3, 23, rng.randint(0, 23)]),
+                rng.choice([0, 30, rng.randint(0, 59)]),
+                rng.randint(0, 59),
+                rng.choice([0, rng.randint(0, 999999)]),
+                tzinfo=tz,
+                fold=rng.randint(0, 1),
+            )
+
+        for tz in zones:
+            for _ in range(300):
+                a = random_datetime(tz)
+                if rng.random() < 0.5:
+                    b = random_datetime(tz)
+                else:
+                    b = a + timedelta(
+                        days=rng.randint(-70, 70), seconds=rng.randint(-90000, 90000)
+                    )
+                for allow_months in [True, False]:
+                    with self.subTest(a=a, b=b, allow_months=allow_months):
+                        self.assertEqual(
+                            NominalDelta.diff(a, b, allow_months=allow_months),
+                            NominalDelta._diff(a, b, allow_months),
+                        )
+
+    def test_diff_datetime_dst(self):
+        tz = ZoneInfo('Europe/Berlin')
+        self.assertEqual(
+            NominalDelta.diff(
+                datetime(2019, 3, 30, 12, tzinfo=tz),
+                datetime(2019, 3, 31, 12, tzinfo=tz),
+            ),
+            NominalDelta(days=1),
+        )
+        self.assertEqual(
+            NominalDelta.diff(
+                datetime(2019, 3, 30, 13, tzinfo=tz),
+                datetime(2019, 3, 31, 12, tzinfo=tz),
+            ),
+            NominalDelta(hours=22),
+        )
+        self.assertEqual(
+            NominalDelta.diff(
+                datetime(2019, 3, 31, 1, 59, tzinfo=tz),
+                datetime(2019, 3, 31, 3, 1, tzinfo=tz),
+            ),
+            NominalDelta(minutes=2),
+        )
+        self.assertEqual(
+            NominalDelta.diff(
+                datetime(2019, 10, 26, 13, tzinfo=tz),
+                datetime(2019, 10, 27, 12, tzinfo=tz),
+            ),
+            NominalDelta(hours=24),
+        )
+        self.assertEqual(
+            NominalDelta.diff(
+                datetime(2019, 9, 27, 2, 30, tzinfo=tz),
+                datetime(2019, 10, 27, 2, 30, fold=1, tzinfo=tz),
+            ),
+            NominalDelta(months=1, hours=1),
+        )
+
     def test_diff_no_allow_months(self):
         self.assertEqual(
             NominalDelta.diff(
@@ -417,6 +634,12 @@ class DiffTests(unittest.TestCase):
             ),
             NominalDelta(days=989, seconds=75287),
         )
+        self.assertEqual(
+            NominalDelta.diff(
+                date(1970, 2, 15), date(1970, 1, 15), allow_months=False
+            ),
+            NominalDelta(days=-31),
+        )
 
     def test_inheritance(self):
         class ChildClass(NominalDelta):
@@ -424,3 +647,1434 @@ class DiffTests(unittest.TestCase):
 
         delta = ChildClass.diff(date(1970, 1, 15), date(1970, 2, 15))
         self.assertEqual(type(delta), ChildClass)
+
+
+class BucketTests(unittest.TestCase):
+    def assertBuckets(self, step, anchor, values):
+        grid = sorted(anchor + step * k for k in range(-200, 201))
+        indices = [step.bucket_index(x, anchor) for x in values]
+        self.assertEqual(list(step.bucket_many(values, anchor)), indices)
+        self.assertEqual(list(step.bucket_many(sorted(values), anchor)), [
+            step.bucket_index(x, anchor) for x in sorted(values)
+        ])
+        for x, k in zip(values, indices):
+            with self.subTest(x=x):
+                floor = max(item for item in grid if item <= x)
+                ceil = min(item for item in grid if item >= x)
+                self.assertEqual(anchor + step * k, floor)
+                self.assertEqual(step.floor(x, anchor), floor)
+                self.assertEqual(step.ceil(x, anchor), ceil)
+
+    def test_months(self):
+        values = [date(2020, 1, 1) + timedelta(days=k) for k in range(-800, 800, 7)]
+        for step in [MONTH, NominalDelta(months=3), NominalDelta(months=-2)]:
+            self.assertBuckets(step, date(2020, 1, 31), values)
+
+    def test_weeks(self):
+        values = [date(2021, 1, 1) + timedelta(days=k) for k in range(-100, 100)]
+        self.assertBuckets(NominalDelta(weeks=2), date(2021, 1, 4), values)
+
+    def test_datetime(self):
+        tz = ZoneInfo('Europe/Berlin')
+        anchor = datetime(2021, 1, 31, 13, 30, tzinfo=tz)
+        values = [anchor + timedelta(hours=k * 11.3) for k in range(-100, 100)]
+        for step in [
+            NominalDelta(hours=7),
+            NominalDelta(days=1),
+            NominalDelta(months=1, days=2, hours=3),
+            NominalDelta(days=-3, hours=-1),
+        ]:
+            self.assertBuckets(step, anchor, values)
+
+    def test_examples(self):
+        quarter = NominalDelta(months=3)
+        anchor = date(2020, 1, 31)
+        self.assertEqual(quarter.bucket_index(date(2020, 4, 30), anchor), 1)
+        self.assertEqual(quarter.bucket_index(date(2020, 4, 29), anchor), 0)
+        self.assertEqual(quarter.bucket_index(date(2020, 1, 30), anchor), -1)
+        self.assertEqual(quarter.floor(date(2020, 6, 1), anchor), date(2020, 4, 30))
+        self.assertEqual(quarter.ceil(date(2020, 6, 1), anchor), date(2020, 7, 31))
+        self.assertEqual(quarter.ceil(date(2020, 7, 31), anchor), date(2020, 7, 31))
+
+    def test_invalid_step(self):
+        with self.assertRaises(ValueError):
+            NominalDelta().bucket_index(date(2021, 1, 1), date(2020, 1, 1))
+        with self.assertRaises(ValueError):
+            NominalDelta(hours=1).floor(date(2021, 1, 1), date(2020, 1, 1))
+        with self.assertRaises(ValueError):
+            NominalDelta(months=1, days=-1).ceil(date(2021, 1, 1), date(2020, 1, 1))
+
+
+class BusinessCalendarTests(unittest.TestCase):
+    holidays = frozenset({
+        date(2021, 1, 1),
+        date(2021, 4, 2),
+        date(2021, 4, 5),
+        date(2021, 12, 24),
+    })
+    calendar = BusinessCalendar(date(2020, 1, 1), date(2023, 1, 1), holidays=holidays)
+
+    def is_business_day(self, d):
+        return d.weekday() < 5 and d not in self.holidays
+
+    def add(self, d, delta):
+        # reference implementation that steps one day at a time
+        d += NominalDelta(months=delta.months)
+        while not self.is_business_day(d):
+            d += timedelta(days=1)
+        step = 1 if delta.days > 0 else -1
+        for _ in range(abs(delta.days)):
+            d += timedelta(days=step)
+            while not self.is_business_day(d):
+                d += timedelta(days=step)
+        return d
+
+    def test_is_business_day(self):
+        d = date(2020, 1, 1)
+        while d < date(2023, 1, 1):
+            self.assertEqual(self.calendar.is_business_day(d), self.is_business_day(d))
+            d += timedelta(days=1)
+
+    def test_add(self):
+        for d in [
+            date(2021, 1, 29),
+            date(2021, 4, 1),
+            date(2021, 4, 3),
+            date(2021, 12, 31),
+        ]:
+            for months in [-3, 0, 1]:
+                for days in [-30, -1, 0, 1, 2, 5, 30]:
+                    delta = NominalDelta(months=months, days=days)
+                    with self.subTest(d=d, delta=delta):
+                        result = self.calendar.add(d, delta)
+                        self.assertEqual(result, self.add(d, delta))
+
+    def test_add_examples(self):
+        self.assertEqual(
+            self.calendar.add(date(2021, 4, 1), NominalDelta(days=1)), date(2021, 4, 6)
+        )
+        self.assertEqual(
+            self.calendar.add(date(2021, 4, 3), NominalDelta()), date(2021, 4, 6)
+        )
+        self.assertEqual(
+            self.calendar.add(date(2021, 1, 31), MONTH), date(2021, 3, 1)
+        )
+        self.assertEqual(
+            self.calendar.add(
+                datetime(2021, 4, 1, 13, 30), NominalDelta(days=1, hours=2)
+            ),
+            datetime(2021, 4, 6, 15, 30),
+        )
+
+    def test_diff(self):
+        for a, b, expected in [
+            (date(2021, 4, 1), date(2021, 4, 6), NominalDelta(days=1)),
+            (date(2021, 4, 6), date(2021, 4, 1), NominalDelta(days=-1)),
+            # 2021-02-28 is a Sunday
+            (date(2021, 1, 29), date(2021, 3, 3), NominalDelta(months=1, days=2)),
+            (date(2021, 3, 1), date(2021, 3, 1), NominalDelta()),
+        ]:
+            with self.subTest(a=a, b=b):
+                self.assertEqual(self.calendar.diff(a, b), expected)
+        self.assertEqual(
+            self.calendar.diff(date(2021, 1, 29), date(2021, 3, 3), allow_months=False),
+            NominalDelta(days=23),
+        )
+        self.assertEqual(self.calendar.count(date(2021, 3, 29), date(2021, 4, 12)), 8)
+
+    def test_diff_roundtrip(self):
+        a = date(2021, 1, 29)
+        b = a
+        while b < date(2023, 1, 1):
+            if self.is_business_day(b):
+                self.assertEqual(self.calendar.add(a, self.calendar.diff(a, b)), b)
+            b += timedelta(days=5)
+
+    def test_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.calendar.add(date(2019, 12, 31), NominalDelta())
+        with self.assertRaises(ValueError):
+            self.calendar.add(date(2022, 12, 1), NominalDelta(days=30))
+        with self.assertRaises(ValueError):
+            self.calendar.add(date(2020, 1, 1), NominalDelta(days=-1))
+        with self.assertRaises(ValueError):
+            BusinessCalendar(date(2021, 1, 1), date(2021, 1, 1))
+        with self.assertRaises(TypeError):
+            self.calendar.diff(datetime(2021, 1, 1), datetime(2021, 1, 2))
+
+
+class IsoformatTests(unittest.TestCase):
+    def test_fromisoformat(self):
+        for s, expected in [
+            (
+                'P1Y2M10DT2H30M',
+                NominalDelta(years=1, months=2, days=10, hours=2, minutes=30),
+            ),
+            ('P3W', NominalDelta(weeks=3)),
+            ('P1W2D', NominalDelta(days=9)),
+            ('PT36H', NominalDelta(hours=36)),
+            ('PT0S', NominalDelta()),
+            ('-P1M1D', NominalDelta(months=-1, days=-1)),
+            ('P-1M1D', NominalDelta(months=-1, days=1)),
+            ('+P1M', MONTH),
+            ('PT1.5S', NominalDelta(seconds=1.5)),
+            ('PT1,5S', NominalDelta(seconds=1.5)),
+        ]:
+            with self.subTest(s=s):
+                self.assertEqual(NominalDelta.fromisoformat(s), expected)
+        self.assertIsInstance(NominalDelta.fromisoformat('PT1S').seconds, int)
+
+    def test_fromisoformat_invalid(self):
+        for s in ['', 'P', 'PT', 'P1YT', '1Y', 'P1.5D', 'P1D2Y', 'P1Y ', 'p1y']:
+            with self.subTest(s=s), self.assertRaises(ValueError):
+                NominalDelta.fromisoformat(s)
+
+    def test_isoformat(self):
+        for delta, expected in [
+            (NominalDelta(), 'PT0S'),
+            (
+                NominalDelta(years=1, months=2, days=10, hours=2, minutes=30),
+                'P1Y2M10DT2H30M',
+            ),
+            (NominalDelta(weeks=1), 'P7D'),
+            (NominalDelta(months=-1, days=-1), '-P1M1D'),
+            (NominalDelta(months=-14, days=3), 'P-1Y-2M3D'),
+            (NominalDelta(seconds=1.5), 'PT1.5S'),
+            (NominalDelta(seconds=1e-5), 'PT0.00001S'),
+        ]:
+            with self.subTest(delta=delta):
+                self.assertEqual(delta.isoformat(), expected)
+
+    def test_roundtrip(self):
+        for months in [-25, -12, -1, 0, 1, 14]:
+            for days in [-8, 0, 3]:
+                for seconds in [-90061, -1, 0, 59, 3600, 86399, 0.1, -2.75]:
+                    delta = NominalDelta(months=months, days=days, seconds=seconds)
+                    with self.subTest(delta=delta):
+                        result = NominalDelta.fromisoformat(delta.isoformat())
+                        self.assertEqual(result, delta)
+
+    def test_parse_many(self):
+        lines = ['P1M\n', 'PT1S\n', 'P1M\n', '-P2D']
+        self.assertEqual(
+            list(NominalDelta.parse_many(lines)),
+            [MONTH, NominalDelta(seconds=1), MONTH, NominalDelta(days=-2)],
+        )
+        with self.assertRaises(ValueError):
+            list(NominalDelta.parse_many(['P1M', 'invalid']))
+
+
+class DiffFromTests(unittest.TestCase):
+    def assertDiffFrom(self, anchor, values):
+        for allow_months in [True, False]:
+            expected = [
+                NominalDelta.diff(x, anchor, allow_months=allow_months) for x in values
+            ]
+            result = NominalDelta.diff_from(anchor, values, allow_months=allow_months)
+            self.assertEqual(list(result), expected)
+
+    def test_dates(self):
+        anchor = date(2021, 1, 31)
+        values = [anchor + timedelta(days=k) for k in range(-1000, 1000, 3)]
+        self.assertDiffFrom(anchor, values)
+        self.assertDiffFrom(anchor, values[::-1])
+
+    def test_datetimes(self):
+        for tz in [None, timezone.utc, ZoneInfo('Europe/Berlin')]:
+            for anchor in [
+                datetime(2021, 1, 31, 13, 30, tzinfo=tz),
+                datetime(2021, 3, 28, 2, 30, tzinfo=tz),
+                datetime(2021, 10, 31, 2, 30, fold=1, tzinfo=tz),
+            ]:
+                values = [anchor + timedelta(hours=k * 7.7) for k in range(-500, 500)]
+                with self.subTest(anchor=anchor):
+                    self.assertDiffFrom(anchor, values)
+
+    def test_mixed_zones(self):
+        anchor = datetime(2021, 1, 31, 13, 30, tzinfo=ZoneInfo('Europe/Berlin'))
+        values = [
+            datetime(2021, 3, 1, tzinfo=timezone.utc),
+            datetime(2020, 3, 1, tzinfo=ZoneInfo('America/New_York')),
+        ]
+        self.assertDiffFrom(anchor, values)
+
+    def test_counting(self):
+        anchor = date(2021, 1, 31)
+        values = [date(2021, 3, 1), date(2020, 2, 29), date(2021, 1, 31)]
+        with counting() as expected:
+            for x in values:
+                NominalDelta.diff(x, anchor)
+        with counting() as result:
+            list(NominalDelta.diff_from(anchor, values))
+        self.assertEqual(
+            result['month_search_probes'], expected['month_search_probes']
+        )
+
+    def test_unsupported_types(self):
+        with self.assertRaises(TypeError):
+            list(NominalDelta.diff_from(date(2021, 1, 1), [datetime(2021, 1, 1)]))
+        with self.assertRaises(TypeError):
+            list(NominalDelta.diff_from('2021-01-01', [date(2021, 1, 1)]))
+
+
+class ParallelTests(unittest.TestCase):
+    tz = ZoneInfo('Europe/Berlin')
+    values = (
+        date(2021, 1, 31),
+        datetime(2021, 1, 31, 13, 30, 15, 123456),
+        datetime(2021, 3, 28, 3, 30, tzinfo=tz),
+        datetime(2021, 10, 31, 2, 30, fold=1, tzinfo=tz),
+        datetime(1999, 12, 31, 23, 59, tzinfo=timezone(timedelta(hours=-5))),
+        datetime(2000, 2, 29, tzinfo=timezone.utc),
+    )
+
+    def test_diff_parallel(self):
+        pairs = [
+            (a, b)
+            for a in self.values
+            for b in self.values
+            if type(a) is type(b)
+            and (getattr(a, 'tzinfo', None) is None)
+            == (getattr(b, 'tzinfo', None) is None)
+        ]
+        for allow_months in [True, False]:
+            expected = [
+                NominalDelta.diff(a, b, allow_months=allow_months) for a, b in pairs
+            ]
+            result = diff_parallel(
+                iter(pairs), workers=2, chunksize=3, allow_months=allow_months
+            )
+            self.assertEqual(list(result), expected)
+
+    def test_add_parallel(self):
+        delta = NominalDelta(months=1, days=2, hours=3)
+        result = list(add_parallel(self.values, delta, workers=2, chunksize=4))
+        expected = [value + delta for value in self.values]
+        self.assertEqual(result, expected)
+        for a, b in zip(result[1:], expected[1:]):
+            self.assertEqual(a.tzinfo, b.tzinfo)
+            self.assertEqual(a.fold, b.fold)
+        self.assertIs(result[2].tzinfo, self.tz)
+
+    def test_add_parallel_subclass(self):
+        class MyDate(date):
+            pass
+
+        class MyDatetime(datetime):
+            pass
+
+        values = [MyDate(2021, 1, 31), MyDatetime(2021, 1, 31, 13, 30)]
+        result = list(add_parallel(values, MONTH, workers=1))
+        self.assertEqual(result, [value + MONTH for value in values])
+        self.assertEqual([type(x) for x in result], [MyDate, MyDatetime])
+
+    def test_map_diff(self):
+        pairs = [
+            (a, b)
+            for a in self.values
+            for b in self.values
+            if type(a) is type(b)
+            and (getattr(a, 'tzinfo', None) is None)
+            == (getattr(b, 'tzinfo', None) is None)
+        ]
+        for allow_months in [True, False]:
+            expected = [
+                NominalDelta.diff(a, b, allow_months=allow_months) for a, b in pairs
+            ]
+            result = map_diff(
+                iter(pairs), workers=3, chunksize=2, allow_months=allow_months
+            )
+            self.assertEqual(list(result), expected)
+
+    def test_map_add(self):
+        delta = NominalDelta(months=1, days=2, hours=3)
+        result = list(map_add(iter(self.values), delta, workers=3, chunksize=1))
+        self.assertEqual(result, [value + delta for value in self.values])
+        self.assertIs(result[2].tzinfo, self.tz)
+
+    def test_map_streaming(self):
+        # results come in order while the input is still being consumed
+        values = (date(2021, 1, 1) + NominalDelta(days=k) for k in itertools.count())
+        result = map_add(values, MONTH, workers=2, chunksize=10)
+        self.assertEqual(next(result), date(2021, 2, 1))
+        self.assertEqual(next(result), date(2021, 2, 2))
+        result.close()
+
+    def test_empty(self):
+        self.assertEqual(list(diff_parallel([], workers=1)), [])
+        self.assertEqual(list(map_diff([], workers=1)), [])
+
+    def test_invalid(self):
+        with self.assertRaises(TypeError):
+            list(add_parallel([date(2021, 1, 1)], 1, workers=1))
+        with self.assertRaises(TypeError):
+            list(diff_parallel([(1, 2)], workers=1))
+        with self.assertRaises(ValueError):
+            list(diff_parallel([], chunksize=0))
+        with self.assertRaises(TypeError):
+            list(map_add([date(2021, 1, 1)], 1, workers=1))
+        with self.assertRaises(TypeError):
+            list(map_diff([(1, 2)], workers=1))
+
+
+class ThreadSafetyTests(unittest.TestCase):
+    # runs the same work on many threads at once and compares with the
+    # single threaded results
+    tz = ZoneInfo('Europe/Berlin')
+
+    def setUp(self):
+        rng = random.Random(0)
+        start = datetime(2019, 1, 31, 2, 30)
+        start_date = date(2020, 1, 31)
+        self.dates = [start_date + NominalDelta(days=k) for k in range(0, 800, 9)]
+        self.datetimes = []
+        for tzinfo in [None, timezone.utc, self.tz]:
+            for _ in range(40):
+                dt = start + timedelta(minutes=rng.randrange(3 * 365 * 24 * 60))
+                self.datetimes.append(dt.replace(tzinfo=tzinfo))
+        self.deltas = [
+            MONTH,
+            NominalDelta(months=1, days=2, hours=3),
+            NominalDelta(days=-10, seconds=0.25),
+            NominalDelta(hours=-25),
+        ]
+        self.pairs = [(a, b) for a in self.dates[::5] for b in self.dates[::3]]
+        self.pairs += [
+            (a, b)
+            for a in self.datetimes
+            for b in self.datetimes[::7]
+            if a.tzinfo is b.tzinfo
+        ]
+
+    def work(self, k):
+        # a mix of everything that may share state between threads
+        a, b = self.pairs[k % len(self.pairs)]
+        delta = self.deltas[k % len(self.deltas)]
+        diff = NominalDelta.diff(a, b)
+        return (
+            diff,
+            a + delta,
+            b - delta * k,
+            hash(diff + delta),
+            NominalDelta.fromisoformat((diff * k).isoformat()),
+        )
+
+    def test_stress(self):
+        n = 2000
+        with counting() as expected_counts:
+            expected = [self.work(k) for k in range(n)]
+        with caching(maxsize=16) as cache, counting() as counts:
+            # the workers share the cache and counters through the context
+            context = contextvars.copy_context()
+            with ThreadPoolExecutor(8) as executor:
+                results = list(
+                    executor.map(
+                        lambda k: context.copy().run(self.work, k), range(n)
+                    )
+                )
+        self.assertEqual(results, expected)
+        info = cache.info()
+        self.assertEqual(
+            info['hits'] + info['misses'],
+            sum(type(self.pairs[k % len(self.pairs)][0]) is date for k in range(n)),
+        )
+        self.assertLessEqual(info['size'], 16)
+        self.assertGreater(counts['dt_add_round_trips'], 0)
+        # date diffs may be served from the cache, everything else is exact
+        self.assertEqual(
+            counts['dt_add_round_trips'], expected_counts['dt_add_round_trips']
+        )
+
+    def test_stress_map(self):
+        values = self.dates + self.datetimes
+        for delta in self.deltas:
+            expected = [value + delta for value in values]
+            self.assertEqual(
+                list(map_add(values, delta, workers=8, chunksize=5)), expected
+            )
+        expected = [NominalDelta.diff(a, b) for a, b in self.pairs]
+        with caching(maxsize=8):
+            result = list(map_diff(self.pairs, workers=8, chunksize=5))
+        self.assertEqual(result, expected)
+
+    def test_stress_map_contexts(self):
+        # caching() and counting() of the caller apply to the worker threads
+        with counting() as expected:
+            for a, b in self.pairs:
+                NominalDelta.diff(a, b)
+        with caching(maxsize=8) as cache, counting() as counts:
+            list(map_diff(self.pairs, workers=8, chunksize=5))
+        info = cache.info()
+        self.assertEqual(
+            info['hits'] + info['misses'],
+            sum(type(a) is date for a, _ in self.pairs),
+        )
+        self.assertEqual(counts['dt_add_round_trips'], expected['dt_add_round_trips'])
+
+    def test_stress_concurrent_contexts(self):
+        # every thread enters its own caching() and counting() contexts
+        n = 200
+        with counting() as expected_counts:
+            expected = [self.work(k) for k in range(n)]
+        barrier = threading.Barrier(8)
+
+        def run(offset):
+            barrier.wait()
+            with caching(maxsize=4) as cache, counting() as counts:
+                results = [self.work(k) for k in range(n)]
+                with counting() as inner:
+                    results.append(self.work(offset))
+            return results, cache.info(), counts, inner
+
+        with ThreadPoolExecutor(8) as executor:
+            runs = list(executor.map(run, range(8)))
+        dates = sum(type(self.pairs[k % len(self.pairs)][0]) is date for k in range(n))
+        for offset, (results, info, counts, inner) in enumerate(runs):
+            self.assertEqual(results, expected + [self.work(offset)])
+            is_date = type(self.pairs[offset][0]) is date
+            self.assertEqual(info['hits'] + info['misses'], dates + is_date)
+            for key in ['dt_add_round_trips', 'diff_corrections']:
+                self.assertEqual(counts[key], expected_counts[key] + inner[key])
+        # nothing is left enabled after all contexts have exited
+        snapshot = [dict(counts) for _, _, counts, _ in runs]
+        self.work(0)
+        self.assertEqual([counts for _, _, counts, _ in runs], snapshot)
+
+    def test_cache_toggle(self):
+        # enabling and disabling the cache while other threads use it
+        a, b = date(2021, 1, 31), date(2021, 3, 1)
+        expected = NominalDelta.diff(a, b)
+
+        def toggle(k):
+            if k % 2:
+                enable_cache(maxsize=4)
+            else:
+                disable_cache()
+            return NominalDelta.diff(a, b)
+
+        try:
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(toggle, range(2000)))
+        finally:
+            disable_cache()
+        self.assertEqual(results, [expected] * 2000)
+
+
+class MonthSearchTests(unittest.TestCase):
+    def assert_same_as_binary_search(self, a, b):
+        delta = NominalDelta(months=1)
+        self.assertEqual(month_search(a, b, delta), binary_search(a, b, delta))
+
+    def test_month_search_date(self):
+        start = date(1999, 12, 25)
+        for i in range(800):
+            a = start + timedelta(days=i)
+            for j in [0, 1, 27, 28, 29, 30, 31, 59, 365, 366, 10_000]:
+                self.assert_same_as_binary_search(a, a + timedelta(days=j))
+
+    def test_month_search_datetime(self):
+        tz = ZoneInfo('Europe/Berlin')
+        for a, b in [
+            (datetime(2019, 1, 31, 2, 30), datetime(2019, 3, 31, 2, 29)),
+            (datetime(2019, 1, 31, 2, 30), datetime(2019, 3, 31, 2, 30)),
+            (datetime(2019, 2, 28, 2, 30), datetime(2019, 3, 31, 3)),
+            (
+                datetime(2019, 2, 28, 2, 30, tzinfo=tz),
+                datetime(2019, 3, 31, 3, 30, tzinfo=tz),
+            ),
+            (
+                datetime(2019, 9, 27, 2, 30, fold=1, tzinfo=tz),
+                datetime(2019, 10, 27, 2, 30, tzinfo=tz),
+            ),
+            (
+                datetime(2019, 9, 27, 2, 30, tzinfo=tz),
+                datetime(2019, 10, 27, 2, 30, fold=1, tzinfo=tz),
+            ),
+            (
+                datetime(2019, 1, 31, 23, 30, tzinfo=tz),
+                datetime(2019, 2, 28, 23, tzinfo=timezone.utc),
+            ),
+            (
+                datetime(2019, 1, 1, tzinfo=timezone.utc),
+                datetime(2019, 2, 1, tzinfo=tz),
+            ),
+        ]:
+            self.assert_same_as_binary_search(a, b)
+
+
+class CountingTests(unittest.TestCase):
+    def test_counting_disabled(self):
+        with counting() as counters:
+            pass
+        NominalDelta.diff(datetime(1921, 1, 31, 13), datetime(2021, 1, 15, 2))
+        self.assertEqual(set(counters.values()), {0})
+
+    def test_counting_diff(self):
+        with counting() as counters:
+            NominalDelta.diff(date(1921, 1, 31), date(2021, 1, 15))
+        self.assertEqual(counters['month_search_probes'], 2)
+        self.assertEqual(counters['binary_search_probes'], 0)
+        self.assertEqual(counters['date_add_clips'], 0)
+
+        with counting() as counters:
+            NominalDelta.diff(datetime(2021, 1, 31, 13), datetime(2021, 3, 1, 2))
+        self.assertEqual(counters['month_search_probes'], 2)
+        self.assertEqual(counters['date_add_clips'], 1)
+        self.assertEqual(counters['diff_corrections'], 1)
+        self.assertEqual(counters['dt_add_round_trips'], 2)
+
+    def test_counting_binary_search(self):
+        with counting() as counters:
+            binary_search(date(1921, 1, 15), date(2021, 1, 15), MONTH)
+        self.assertEqual(counters['binary_search_probes'], 22)
+
+    def test_counting_add(self):
+        with counting() as counters:
+            date(2021, 1, 31) + MONTH
+            date(2021, 1, 30) + MONTH
+            date(2021, 1, 28) + MONTH
+            datetime(2021, 1, 31, tzinfo=timezone.utc) + MONTH
+            datetime(2021, 1, 31, tzinfo=ZoneInfo('Europe/Berlin')) + MONTH
+        self.assertEqual(counters['date_add_clips'], 4)
+        self.assertEqual(counters['dt_add_round_trips'], 1)
+
+    def test_counting_nested(self):
+        with counting() as outer:
+            date(2021, 1, 31) + MONTH
+            with counting() as inner:
+                date(2021, 1, 31) + MONTH
+            self.assertEqual(inner['date_add_clips'], 1)
+            self.assertEqual(outer['date_add_clips'], 2)
+
+    def test_counting_overlapping_threads(self):
+        # the first thread enters first and also exits first, which used to
+        # leave counting enabled with a stale outer dict
+        entered = [threading.Event(), threading.Event()]
+        exited = threading.Event()
+        results = [None, None]
+
+        def first():
+            with counting() as counters:
+                entered[0].set()
+                entered[1].wait()
+                date(2021, 1, 31) + MONTH
+            results[0] = dict(counters)
+            exited.set()
+
+        def second():
+            entered[0].wait()
+            with counting() as counters:
+                entered[1].set()
+                for _ in range(2):
+                    date(2021, 1, 31) + MONTH
+                exited.wait()
+            results[1] = counters
+
+        threads = [threading.Thread(target=f) for f in [first, second]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        date(2021, 1, 31) + MONTH
+        self.assertEqual(results[0]['date_add_clips'], 1)
+        self.assertEqual(results[1]['date_add_clips'], 2)
+
+
+class CacheTests(unittest.TestCase):
+    dates = tuple(date(1999, 12, 25) + timedelta(days=i * 3) for i in range(200))
+
+    def test_cached_diff_matches_uncached(self):
+        pairs = [(a, b) for a in self.dates[::10] for b in self.dates[::7]]
+        for allow_months in [True, False]:
+            expected = [
+                NominalDelta.diff(a, b, allow_months=allow_months) for a, b in pairs
+            ]
+            with caching() as cache:
+                for _ in range(2):
+                    self.assertEqual(
+                        [
+                            NominalDelta.diff(a, b, allow_months=allow_months)
+                            for a, b in pairs
+                        ],
+                        expected,
+                    )
+            info = cache.info()
+            self.assertEqual(info['misses'], len(pairs))
+            self.assertEqual(info['hits'], len(pairs))
+
+    def test_cache_subclasses(self):
+        class ChildDate(date):
+            pass
+
+        class ChildDelta(NominalDelta):
+            pass
+
+        with caching() as cache:
+            delta = ChildDelta.diff(date(2021, 1, 31), date(2021, 3, 1))
+            self.assertEqual(type(delta), ChildDelta)
+            delta = NominalDelta.diff(date(2021, 1, 31), date(2021, 3, 1))
+            self.assertEqual(type(delta), NominalDelta)
+            NominalDelta.diff(ChildDate(2021, 1, 31), date(2021, 3, 1))
+            NominalDelta.diff(datetime(2021, 1, 31), datetime(2021, 3, 1))
+        self.assertEqual(cache.info()['misses'], 2)
+        self.assertEqual(cache.info()['hits'], 0)
+
+    def test_cache_eviction(self):
+        a = date(2021, 1, 1)
+        with caching(maxsize=2) as cache:
+            NominalDelta.diff(a, date(2021, 2, 1))
+            NominalDelta.diff(a, date(2021, 2, 2))
+            NominalDelta.diff(a, date(2021, 2, 1))
+            NominalDelta.diff(a, date(2021, 2, 3))
+            NominalDelta.diff(a, date(2021, 2, 1))
+            NominalDelta.diff(a, date(2021, 2, 2))
+        self.assertEqual(
+            cache.info(), {'hits': 2, 'misses': 4, 'size': 2, 'maxsize': 2}
+        )
+        cache.clear()
+        self.assertEqual(
+            cache.info(), {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 2}
+        )
+
+    def test_cache_errors(self):
+        cache = LRUCache()
+
+        def fail():
+            raise OverflowError
+
+        for _ in range(2):
+            with self.assertRaises(OverflowError):
+                cache('key', fail)
+        self.assertEqual(
+            cache.info(), {'hits': 0, 'misses': 2, 'size': 0, 'maxsize': 1024}
+        )
+
+    def test_cache_threads(self):
+        pairs = [(a, b) for a in self.dates[::10] for b in self.dates[::7]]
+        expected = [NominalDelta.diff(a, b) for a, b in pairs]
+        cache = enable_cache(maxsize=50)
+        try:
+            with ThreadPoolExecutor(4) as executor:
+                results = list(
+                    executor.map(lambda pair: NominalDelta.diff(*pair), pairs * 4)
+                )
+        finally:
+            disable_cache()
+        self.assertEqual(results, expected * 4)
+        info = cache.info()
+        self.assertEqual(info['hits'] + info['misses'], len(pairs) * 4)
+
+    def test_caching_overlapping_threads(self):
+        # the first thread enters first and also exits first, which used to
+        # leave the second thread's outer cache enabled for everyone
+        a = date(2021, 1, 31)
+        entered = [threading.Event(), threading.Event()]
+        exited = threading.Event()
+        caches = [None, None]
+
+        def first():
+            with caching() as cache:
+                caches[0] = cache
+                entered[0].set()
+                entered[1].wait()
+                NominalDelta.diff(a, a)
+            exited.set()
+
+        def second():
+            entered[0].wait()
+            with caching() as cache:
+                caches[1] = cache
+                entered[1].set()
+                NominalDelta.diff(a, a + NominalDelta(days=1))
+                exited.wait()
+
+        threads = [threading.Thread(target=f) for f in [first, second]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        NominalDelta.diff(a, a + NominalDelta(days=2))
+        for i, cache in enumerate(caches):
+            key = (NominalDelta, a.toordinal(), a.toordinal() + i, True)
+            self.assertEqual(list(cache.data), [key])
+
+
+class RangeTests(unittest.TestCase):
+    def test_range_no_drift(self):
+        self.assertEqual(
+            list(NominalDelta.range(date(2021, 1, 31), date(2021, 6, 1), MONTH)),
+            [
+                date(2021, 1, 31),
+                date(2021, 2, 28),
+                date(2021, 3, 31),
+                date(2021, 4, 30),
+                date(2021, 5, 31),
+            ],
+        )
+
+    def test_range_matches_loop(self):
+        tz = ZoneInfo('Europe/Berlin')
+        start = datetime(2019, 1, 31, 2, 30, tzinfo=tz)
+        for step in [
+            MONTH,
+            NominalDelta(days=3),
+            NominalDelta(months=1, days=1),
+            NominalDelta(hours=5),
+            NominalDelta(months=-2, seconds=-1),
+        ]:
+            for stop in [
+                start,
+                start + NominalDelta(days=1),
+                start + NominalDelta(years=3),
+                start - NominalDelta(years=3),
+            ]:
+                ascending = start + step > start
+                expected = []
+                k = 0
+                while (
+                    start + step * k < stop if ascending else start + step * k > stop
+                ):
+                    expected.append(start + step * k)
+                    k += 1
+                r = NominalDelta.range(start, stop, step)
+                self.assertEqual(list(r), expected)
+                self.assertEqual(len(r), len(expected))
+                self.assertEqual(list(reversed(r)), expected[::-1])
+                for i, dt in enumerate(expected):
+                    self.assertEqual(r[i], dt)
+                    self.assertIn(dt, r)
+                    self.assertEqual(r.index(dt), i)
+                    self.assertNotIn(dt + NominalDelta(minutes=1), r)
+
+    def test_range_getitem(self):
+        r = NominalDelta.range(date(1900, 1, 31), date(9000, 1, 1), MONTH)
+        self.assertEqual(len(r), 85_200)
+        self.assertEqual(r[50_000], date(6066, 9, 30))
+        self.assertEqual(r[-1], date(8999, 12, 31))
+        with self.assertRaises(IndexError):
+            r[85_200]
+
+    def test_range_slice(self):
+        r = NominalDelta.range(date(2021, 1, 31), date(2022, 1, 1), MONTH)
+        self.assertEqual(
+            list(r[2:8:3]), [date(2021, 3, 31), date(2021, 6, 30)]
+        )
+        self.assertEqual(list(r[::-5]), [r[11], r[6], r[1]])
+        self.assertEqual(len(r[100:]), 0)
+        self.assertNotIn(date(2021, 2, 28), r[2:])
+        self.assertIn(date(2021, 3, 31), r[2:])
+        self.assertEqual(r[2:].index(date(2021, 3, 31)), 0)
+        self.assertEqual(
+            repr(r[2:8:3]),
+            'NominalRange(datetime.date(2021, 1, 31), datetime.date(2022, 1, 1), '
+            'NominalDelta(months=1, days=0, seconds=0))[2:8:3]',
+        )
+
+    def test_range_contains_unsupported_type(self):
+        r = NominalDelta.range(date(2021, 1, 31), date(2022, 1, 1), MONTH)
+        self.assertNotIn('2021-01-31', r)
+        with self.assertRaises(ValueError):
+            r.index(None)
+
+    def test_range_invalid_step(self):
+        with self.assertRaises(ValueError):
+            NominalDelta.range(date(2021, 1, 1), date(2022, 1, 1), NominalDelta())
+        with self.assertRaises(ValueError):
+            NominalDelta.range(
+                date(2021, 1, 1), date(2022, 1, 1), NominalDelta(seconds=1)
+            )
+        with self.assertRaises(ValueError):
+            NominalDelta.range(
+                date(2021, 1, 1), date(2022, 1, 1), NominalDelta(months=1, days=-1)
+            )
+        with self.assertRaises(TypeError):
+            NominalDelta.range(date(2021, 1, 1), date(2022, 1, 1), timedelta(1))
+
+
+class ScheduleTests(unittest.TestCase):
+    def setUp(self):
+        self.schedule = Schedule(
+            [
+                (date(2021, 1, 31), MONTH),
+                (date(2021, 1, 1), NominalDelta(weeks=2), None, 4),
+                (date(2021, 1, 1), NominalDelta(months=3), date(2022, 1, 1)),
+            ]
+        )
+
+    def materialize(self, schedule, stop):
+        result = []
+        for i, (anchor, step, end, count, _) in enumerate(schedule._rules):
+            for k, item in enumerate(NominalDelta.range(anchor, stop, step)):
+                if (end is None or item < end) and (count is None or k < count):
+                    result.append((item, i))
+        return sorted(result)
+
+    def test_schedule(self):
+        self.assertEqual(
+            list(self.schedule.occurrences(stop=date(2021, 4, 1))),
+            [
+                (date(2021, 1, 1), 1),
+                (date(2021, 1, 1), 2),
+                (date(2021, 1, 15), 1),
+                (date(2021, 1, 29), 1),
+                (date(2021, 1, 31), 0),
+                (date(2021, 2, 12), 1),
+                (date(2021, 2, 28), 0),
+                (date(2021, 3, 31), 0),
+            ],
+        )
+
+    def test_schedule_matches_sorted(self):
+        stop = date(2024, 1, 1)
+        self.assertEqual(
+            list(self.schedule.occurrences(stop=stop)),
+            self.materialize(self.schedule, stop),
+        )
+
+    def test_schedule_start(self):
+        stop = date(2024, 1, 1)
+        expected = self.materialize(self.schedule, stop)
+        for start in [
+            date(2020, 1, 1),
+            date(2021, 1, 1),
+            date(2021, 1, 30),
+            date(2021, 2, 28),
+            date(2021, 10, 2),
+            date(2023, 12, 31),
+        ]:
+            self.assertEqual(
+                list(self.schedule.occurrences(start, stop)),
+                [item for item in expected if item[0] >= start],
+            )
+
+    def test_schedule_finite(self):
+        schedule = Schedule()
+        self.assertEqual(schedule.add(date(2021, 1, 1), MONTH, count=2), 0)
+        self.assertEqual(schedule.add(date(2021, 1, 1), MONTH, date(2021, 1, 1)), 1)
+        self.assertEqual(len(schedule), 2)
+        self.assertEqual(list(schedule), [(date(2021, 1, 1), 0), (date(2021, 2, 1), 0)])
+
+    def test_schedule_datetime(self):
+        tz = ZoneInfo('Europe/Berlin')
+        schedule = Schedule(
+            [
+                (datetime(2021, 3, 27, 2, 30, tzinfo=tz), NominalDelta(days=1)),
+                (datetime(2021, 3, 27, tzinfo=tz), NominalDelta(hours=12)),
+            ]
+        )
+        start = datetime(2021, 3, 28, tzinfo=tz)
+        self.assertEqual(
+            list(schedule.occurrences(start, datetime(2021, 3, 29, 6, tzinfo=tz))),
+            [
+                (datetime(2021, 3, 28, tzinfo=tz), 1),
+                (datetime(2021, 3, 28, 3, 30, tzinfo=tz), 0),
+                (datetime(2021, 3, 28, 13, tzinfo=tz), 1),
+                (datetime(2021, 3, 29, 1, tzinfo=tz), 1),
+                (datetime(2021, 3, 29, 2, 30, tzinfo=tz), 0),
+            ],
+        )
+
+    def test_schedule_many_rules(self):
+        rng = random.Random(0)
+        steps = [MONTH, NominalDelta(weeks=2), NominalDelta(days=10)]
+        schedule = Schedule(
+            (date(2021, 1, 1) + NominalDelta(days=rng.randrange(60)), rng.choice(steps))
+            for _ in range(500)
+        )
+        stop = date(2021, 6, 1)
+        self.assertEqual(
+            list(schedule.occurrences(stop=stop)), self.materialize(schedule, stop)
+        )
+
+    def test_schedule_invalid(self):
+        schedule = Schedule()
+        with self.assertRaises(ValueError):
+            schedule.add(date(2021, 1, 1), NominalDelta(months=-1))
+        with self.assertRaises(ValueError):
+            schedule.add(date(2021, 1, 1), NominalDelta(seconds=1))
+        with self.assertRaises(ValueError):
+            schedule.add(date(2021, 1, 1), MONTH, count=-1)
+        with self.assertRaises(TypeError):
+            schedule.add(date(2021, 1, 1), 1)
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class Datetime64Tests(unittest.TestCase):
+    deltas = (
+        NominalDelta(months=1),
+        NominalDelta(months=-13, days=3),
+        NominalDelta(years=4, days=-40, hours=25),
+        NominalDelta(days=1, seconds=-0.75),
+        NominalDelta(months=7, minutes=-61, seconds=30.5),
+    )
+
+    def test_add_date_matches_date_add(self):
+        dates = [date(1900, 1, 1) + timedelta(days=i) for i in range(0, 73_000, 7)]
+        array = np.array(dates, dtype='datetime64[D]')
+        for delta in self.deltas:
+            result = delta.add_to(array)
+            self.assertEqual(result.dtype, np.dtype('datetime64[D]'))
+            self.assertEqual(result.tolist(), [date_add(d, delta) for d in dates])
+
+    def test_add_datetime_matches_dt_add(self):
+        dts = [
+            datetime(1900, 1, 31, 13, 7, 11, 250_000) + timedelta(hours=i * 37)
+            for i in range(0, 48_000, 3)
+        ]
+        for unit in ['s', 'us']:
+            array = np.array(dts, dtype=f'datetime64[{unit}]')
+            for delta in self.deltas:
+                expected = [
+                    (dt.replace(tzinfo=timezone.utc) + delta).replace(tzinfo=None)
+                    for dt in array.tolist()
+                ]
+                self.assertEqual(delta.add_to(array).tolist(), expected)
+
+    def test_add_clip(self):
+        array = np.array(['2021-01-31', '2020-01-30', '2021-03-31'], dtype='M8[D]')
+        self.assertEqual(
+            NominalDelta(months=1).add_to(array).tolist(),
+            [date(2021, 2, 28), date(2020, 2, 29), date(2021, 4, 30)],
+        )
+
+    def test_add_nat(self):
+        array = np.array(['NaT', '2021-01-31T12:00'], dtype='M8[s]')
+        result = NominalDelta(months=1, hours=1).add_to(array)
+        self.assertTrue(np.isnat(result[0]))
+        self.assertEqual(result[1], np.datetime64('2021-02-28T13:00'))
+
+    def test_add_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            NominalDelta(days=1).add_to(np.arange(3))
+
+    def assert_diff_many(self, a, b, expected):
+        months, days, seconds = NominalDelta.diff_many(a, b)
+        self.assertEqual(
+            [
+                NominalDelta(months=int(m), days=int(d), seconds=float(s))
+                for m, d, s in zip(months, days, seconds)
+            ],
+            expected,
+        )
+
+    def test_diff_many_date_matches_diff(self):
+        a = [date(1900, 1, 1) + timedelta(days=i * 13) for i in range(3000)]
+        b = [date(1970, 1, 31) + timedelta(days=i * 29) for i in range(3000)]
+        for allow_months in [True, False]:
+            months, days, seconds = NominalDelta.diff_many(
+                np.array(a, dtype='M8[D]'),
+                np.array(b, dtype='M8[D]'),
+                allow_months=allow_months,
+            )
+            self.assertEqual(
+                [
+                    NominalDelta(months=int(m), days=int(d))
+                    for m, d in zip(months, days)
+                ],
+                [
+                    NominalDelta.diff(x, y, allow_months=allow_months)
+                    for x, y in zip(a, b)
+                ],
+            )
+            self.assertFalse(seconds.any())
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), 'time.tzset() is not available')
+    def test_diff_many_datetime_matches_diff(self):
+        # diff() uses the local zone for naive datetimes, diff_many() uses UTC
+        patcher = mock.patch.dict(os.environ, {'TZ': 'UTC'})
+        patcher.start()
+        self.addCleanup(time.tzset)
+        self.addCleanup(patcher.stop)
+        time.tzset()
+        a = [
+            datetime(1900, 1, 31, 13) + timedelta(seconds=i * 7919)
+            for i in range(3000)
+        ]
+        b = [
+            datetime(1970, 3, 1) + timedelta(seconds=i * 104_729)
+            for i in range(3000)
+        ]
+        for allow_months in [True, False]:
+            months, days, seconds = NominalDelta.diff_many(
+                np.array(a, dtype='M8[s]'),
+                np.array(b, dtype='M8[us]'),
+                allow_months=allow_months,
+            )
+            self.assertEqual(
+                [
+                    NominalDelta(months=int(m), days=int(d), seconds=float(s))
+                    for m, d, s in zip(months, days, seconds)
+                ],
+                [
+                    NominalDelta.diff(x, y, allow_months=allow_months)
+                    for x, y in zip(a, b)
+                ],
+            )
+
+    def test_diff_many_full_month(self):
+        self.assert_diff_many(
+            np.array(['2003-01-31T23:59:59', '2003-03-01'], dtype='M8[s]'),
+            np.array(['2003-03-01', '2003-01-31T23:59:59'], dtype='M8[s]'),
+            [NominalDelta(months=1, seconds=1), NominalDelta(months=-1, seconds=-1)],
+        )
+
+    def test_diff_many_broadcast(self):
+        self.assert_diff_many(
+            np.datetime64('2021-01-31', 'D'),
+            np.array(['2021-02-28', '2021-03-30'], dtype='M8[D]'),
+            [NominalDelta(months=1), NominalDelta(months=1, days=30)],
+        )
+
+    def test_diff_many_nat(self):
+        with self.assertRaises(ValueError):
+            NominalDelta.diff_many(
+                np.array(['NaT'], dtype='M8[D]'),
+                np.array(['2021-01-01'], dtype='M8[D]'),
+            )
+
+    def test_diff_many_unsupported_type(self):
+        with self.assertRaises(TypeError):
+            NominalDelta.diff_many(np.arange(3), np.arange(3))
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class NominalDeltaArrayTests(unittest.TestCase):
+    def setUp(self):
+        self.deltas = [
+            NominalDelta(months=1),
+            NominalDelta(months=-13, days=3),
+            NominalDelta(years=4, days=-40, hours=25),
+            NominalDelta(months=1),
+            NominalDelta(days=1, seconds=-45),
+        ]
+
+    def test_roundtrip(self):
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        self.assertEqual(len(array), 5)
+        self.assertEqual(array.tolist(), self.deltas)
+        self.assertEqual(list(array), self.deltas)
+        self.assertEqual(array[2], self.deltas[2])
+        self.assertEqual(array[np.int64(-1)], self.deltas[-1])
+        self.assertEqual(array[1:3].tolist(), self.deltas[1:3])
+        self.assertIsInstance(array[0].seconds, int)
+
+    def test_roundtrip_float_seconds(self):
+        deltas = [NominalDelta(seconds=1.5), NominalDelta(days=1)]
+        array = NominalDeltaArray.from_deltas(deltas)
+        self.assertEqual(array.tolist(), deltas)
+        self.assertEqual(array[0].seconds, 1.5)
+
+    def test_arithmetic(self):
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        other = NominalDeltaArray.from_deltas(self.deltas[::-1])
+        delta = NominalDelta(months=2, seconds=7)
+        self.assertEqual(
+            (array + other).tolist(),
+            [a + b for a, b in zip(self.deltas, self.deltas[::-1])],
+        )
+        self.assertEqual(
+            (array - other).tolist(),
+            [a - b for a, b in zip(self.deltas, self.deltas[::-1])],
+        )
+        self.assertEqual((array + delta).tolist(), [d + delta for d in self.deltas])
+        self.assertEqual((delta + array).tolist(), [delta + d for d in self.deltas])
+        self.assertEqual((delta - array).tolist(), [delta - d for d in self.deltas])
+        self.assertEqual((-array).tolist(), [-d for d in self.deltas])
+        self.assertEqual((array * 3).tolist(), [d * 3 for d in self.deltas])
+        self.assertEqual((3 * array).tolist(), [3 * d for d in self.deltas])
+        self.assertEqual(
+            (array * np.arange(5)).tolist(),
+            [d * i for i, d in enumerate(self.deltas)],
+        )
+
+    def test_microseconds(self):
+        # no float drift, the same as NominalDelta
+        array = NominalDeltaArray.from_deltas(
+            [NominalDelta(seconds=0.1), NominalDelta(seconds=0.3)]
+        )
+        result = array * 3 == NominalDelta(seconds=0.9)
+        self.assertEqual(result.tolist(), [False, True])
+        self.assertEqual(array.microseconds.dtype, np.int64)
+        self.assertEqual(array.seconds.tolist(), [0.1, 0.3])
+        self.assertEqual((array * 10).seconds.dtype, np.int64)
+        unique = NominalDeltaArray(seconds=[0.3, 0.1 + 0.2]).unique()
+        self.assertEqual(unique.tolist(), [NominalDelta(seconds=0.3)])
+        self.assertEqual(
+            NominalDeltaArray(seconds=[0.1] * 10).sum(), NominalDelta(seconds=1)
+        )
+        with self.assertRaises(TypeError):
+            NominalDeltaArray(seconds=['1'])
+
+    def test_fractional_months_and_days(self):
+        with self.assertRaises(ValueError):
+            NominalDeltaArray(months=[1.5, 2.7])
+        with self.assertRaises(ValueError):
+            NominalDeltaArray(days=[0.9, 1])
+        with self.assertRaises(ValueError):
+            NominalDeltaArray(months=['1'])
+        self.assertEqual(NominalDeltaArray(months=[]).tolist(), [])
+
+    def test_add_to_unit(self):
+        dts = np.array(['2021-01-31T12:00:00'], dtype='M8[s]')
+        array = NominalDeltaArray(seconds=[2])
+        self.assertEqual(array.add_to(dts).dtype, np.dtype('M8[s]'))
+        array = NominalDeltaArray(seconds=[0.000001])
+        result = array.add_to(dts)
+        self.assertEqual(result.dtype, np.dtype('M8[us]'))
+        self.assertEqual(result.tolist(), [datetime(2021, 1, 31, 12, 0, 0, 1)])
+
+    def test_unsupported_arithmetic(self):
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        with self.assertRaises(TypeError):
+            array * 1.5
+        with self.assertRaises(TypeError):
+            array + 1
+        with self.assertRaises(TypeError):
+            hash(array)
+
+    def test_sum(self):
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        self.assertEqual(array.sum(), sum(self.deltas, NominalDelta()))
+
+    def test_eq(self):
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        self.assertEqual(
+            (array == NominalDelta(months=1)).tolist(),
+            [True, False, False, True, False],
+        )
+        self.assertEqual(
+            (NominalDelta(months=1) != array).tolist(),
+            [False, True, True, False, True],
+        )
+        other = NominalDeltaArray.from_deltas(self.deltas)
+        self.assertTrue((array == other).all())
+
+    def test_unique(self):
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        unique, inverse, counts = array.unique(
+            return_inverse=True, return_counts=True
+        )
+        self.assertEqual(len(unique), 4)
+        self.assertEqual(unique[inverse].tolist(), self.deltas)
+        self.assertEqual(
+            dict(zip(unique.tolist(), counts.tolist())),
+            {d: self.deltas.count(d) for d in self.deltas},
+        )
+
+    def test_add_to(self):
+        dates = [date(2021, 1, 31) + timedelta(days=i * 17) for i in range(5)]
+        array = NominalDeltaArray.from_deltas(self.deltas)
+        expected = [d + delta for d, delta in zip(dates, self.deltas)]
+        dates = np.array(dates, dtype='M8[D]')
+        self.assertEqual(array.add_to(dates).tolist(), expected)
+        self.assertEqual((dates + array).tolist(), expected)
+
+        dts = [
+            datetime(2021, 1, 31, 13, tzinfo=timezone.utc) + timedelta(hours=i * 401)
+            for i in range(5)
+        ]
+        array = NominalDeltaArray.from_deltas(
+            [*self.deltas[:4], NominalDelta(seconds=1.25)]
+        )
+        expected = [
+            (dt + delta).replace(tzinfo=None) for dt, delta in zip(dts, array)
+        ]
+        dts = np.array([dt.replace(tzinfo=None) for dt in dts], dtype='M8[s]')
+        self.assertEqual(array.add_to(dts).tolist(), expected)
+        self.assertEqual((dts - -array).tolist(), expected)
+
+    def test_diff_many(self):
+        a = np.array(['2021-01-31', '2020-02-29'], dtype='M8[D]')
+        b = np.array(['2021-03-01', '2019-02-28'], dtype='M8[D]')
+        array = NominalDeltaArray(*NominalDelta.diff_many(a, b))
+        self.assertEqual(
+            array.tolist(),
+            [NominalDelta(months=1, days=1), NominalDelta(years=-1, days=-1)],
+        )
+        self.assertEqual((a[:1] + array[:1]).tolist(), b[:1].tolist())
+
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class FileFormatTests(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_deltas(self):
+        deltas = [
+            NominalDelta(months=1),
+            NominalDelta(months=-13, days=3),
+            NominalDelta(years=4, days=-40, hours=25),
+            NominalDelta(days=1, seconds=-45),
+            NominalDelta(),
+        ]
+        save(self.path, deltas)
+        array = load(self.path)
+        self.assertIsInstance(array, NominalDeltaArray)
+        self.assertIsInstance(array.months, np.memmap)
+        self.assertFalse(array.months.flags.writeable)
+        self.assertEqual(array.tolist(), deltas)
+        self.assertEqual(array[2], deltas[2])
+        self.assertIsInstance(array[2].seconds, int)
+        self.assertEqual(load(self.path, mmap=False).tolist(), deltas)
+
+    def test_float_seconds(self):
+        deltas = [NominalDelta(seconds=1.5), NominalDelta(days=1, seconds=0.1)]
+        save(self.path, NominalDeltaArray.from_deltas(deltas))
+        self.assertEqual(load(self.path).tolist(), deltas)
+
+    def test_layout(self):
+        save(self.path, [NominalDelta(months=1, days=2, seconds=3)])
+        self.assertEqual(
+            np.load(self.path).dtype,
+            np.dtype([('months', '<i8'), ('days', '<i8'), ('microseconds', '<i8')]),
+        )
+
+    def test_dates(self):
+        dates = list(NominalDelta.range(date(2020, 1, 31), date(2021, 1, 1), MONTH))
+        save(self.path, dates)
+        array = load(self.path)
+        self.assertEqual(array.dtype, np.dtype('<M8[D]'))
+        self.assertEqual(array.tolist(), dates)
+
+    def test_datetimes(self):
+        tz = ZoneInfo('Europe/Berlin')
+        dts = [
+            datetime(2021, 3, 28, 1, 30, 0, 123456),
+            datetime(1900, 1, 1),
+        ]
+        save(self.path, dts)
+        self.assertEqual(load(self.path).tolist(), dts)
+
+        save(self.path, [datetime(2021, 3, 28, 3, 30, tzinfo=tz)])
+        self.assertEqual(load(self.path).tolist(), [datetime(2021, 3, 28, 1, 30)])
+
+    def test_datetime64(self):
+        array = np.array(['2021-01-31T12:00', 'NaT'], dtype='M8[m]')
+        save(self.path, array)
+        np.testing.assert_array_equal(load(self.path), array)
+
+    def test_unsupported(self):
+        with self.assertRaises(TypeError):
+            save(self.path, [date(2021, 1, 1), datetime(2021, 1, 1)])
+        with self.assertRaises(TypeError):
+            save(self.path, np.arange(3))
+        np.save(self.path, np.arange(3))
+        with self.assertRaises(ValueError):
+            load(self.path)
+
+
+class CommandLineTests(unittest.TestCase):
+    def run_main(self, argv, stdin, status=0):
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with mock.patch('sys.stdin', io.StringIO(stdin)), mock.patch(
+            'sys.stdout', stdout
+        ), mock.patch('sys.stderr', stderr):
+            self.assertEqual(main(argv), status)
+        self.stderr = stderr.getvalue()
+        if status == 0:
+            self.assertIn('rows/s', self.stderr)
+        return stdout.getvalue()
+
+    def test_bad_rows(self):
+        argv = ['diff', '--col', 'a', '--col', 'b', '--chunksize', '2']
+        for stdin, message in [
+            ('a,b\n2021-01-01,2021-02-01\nnotadate,2021-01-01\n', 'ValueError'),
+            ('a,b\n2021-01-01,2021-02-01\n2021-01-01,2021-01-01T12\n', 'TypeError'),
+            ('a,b\n2021-01-01,2021-02-01\n2021-01-01\n', 'IndexError'),
+        ]:
+            self.assertEqual(
+                self.run_main(argv, stdin, status=1),
+                'a,b,delta\n2021-01-01,2021-02-01,P1M\n',
+            )
+            self.assertTrue(self.stderr.startswith(f'error: row 2: {message}'))
+            self.assertEqual(self.stderr.count('\n'), 1)
+
+        stdin = '{"a": "2021-01-01"}\n{"b": "2021-01-01"}\n' * 3
+        argv = ['add', '--delta', 'P1D', '--col', 'a', '--format', 'ndjson']
+        self.run_main(argv + ['--chunksize', '2'], stdin, status=1)
+        self.assertEqual(self.stderr, "error: row 2: KeyError: 'a'\n")
+
+    def test_skip_bad_rows(self):
+        stdin = 'a\n2021-01-01\nnotadate\n2021-01-02\n9999-12-31\n2021-01-03\n'
+        argv = ['add', '--delta', 'P1D', '--errors', 'skip', '--chunksize', '2']
+        self.assertEqual(
+            self.run_main(argv, stdin), 'a\n2021-01-02\n2021-01-03\n2021-01-04\n'
+        )
+        lines = self.stderr.splitlines()
+        self.assertTrue(lines[0].startswith('skipped row 2: ValueError'))
+        self.assertTrue(lines[1].startswith('skipped row 4: '))
+        self.assertIn('3 rows', lines[2])
+
+    def test_add_csv(self):
+        stdin = 'id,start\n1,2021-01-31\n2,2021-03-28T01:30:00\n3,\n'
+        self.assertEqual(
+            self.run_main(['add', '--delta', 'P1M', '--col', 'start'], stdin),
+            'id,start\n1,2021-01-31\n2,2021-03-28T01:30:00\n3,\n'.replace(
+                '2021-01-31', '2021-02-28'
+            ).replace('2021-03-28T', '2021-04-28T'),
+        )
+
+    def test_add_default_column(self):
+        stdin = 'start,id\n2021-01-31T12:00:00,1\n'
+        self.assertEqual(
+            self.run_main(['add', '--delta', 'P1D', '--tz', 'Europe/Berlin'], stdin),
+            'start,id\n2021-02-01T12:00:00+01:00,1\n',
+        )
+
+    def test_diff_csv(self):
+        stdin = (
+            'start,end\n'
+            '2021-01-31,2021-03-01\n'
+            '2021-03-28T01:30:00,2021-03-28T03:30:00\n'
+            '2021-03-01,\n'
+        )
+        argv = ['diff', '--col', 'start', '--col', 'end', '--tz', 'Europe/Berlin']
+        expected = (
+            'start,end,delta\n'
+            '2021-01-31,2021-03-01,P1M1D\n'
+            '2021-03-28T01:30:00,2021-03-28T03:30:00,PT1H\n'
+            '2021-03-01,,\n'
+        )
+        self.assertEqual(self.run_main(argv, stdin), expected)
+        self.assertEqual(self.run_main([*argv, '--chunksize', '1'], stdin), expected)
+        self.assertEqual(
+            self.run_main([*argv, '--workers', '2', '--chunksize', '1'], stdin),
+            expected,
+        )
+
+    def test_diff_ndjson(self):
+        stdin = (
+            '{"a": "2021-01-31T12:00:00Z", "b": "2021-03-01T12:00:00Z"}\n'
+            '\n'
+            '{"a": null, "b": "2021-03-01"}\n'
+        )
+        argv = ['diff', '--format', 'ndjson', '--col', 'a', '--col', 'b']
+        self.assertEqual(
+            self.run_main([*argv, '--no-months', '--output', 'd'], stdin),
+            '{"a": "2021-01-31T12:00:00Z", "b": "2021-03-01T12:00:00Z", "d": "P29D"}\n'
+            '{"a": null, "b": "2021-03-01", "d": null}\n',
+        )
+
+    def test_empty(self):
+        self.assertEqual(self.run_main(['add', '--delta', 'P1D'], ''), '')
+
+    def test_invalid_arguments(self):
+        for argv in [
+            ['add'],
+            ['add', '--delta', 'invalid'],
+            ['add', '--delta', 'P1D', '--col', 'missing'],
+            ['add', '--delta', 'P1D', '--tz', 'Invalid/Zone'],
+            ['diff', '--col', 'start'],
+            ['add', '--delta', 'P1D', '--chunksize', '0'],
+            ['add', '--delta', 'P1D', '--chunksize', '-1'],
+            ['add', '--delta', 'P1D', '--workers', '-1'],
+        ]:
+            stdin = mock.patch('sys.stdin', io.StringIO('start\n'))
+            stderr = mock.patch('sys.stderr', io.StringIO())
+            with self.subTest(argv=argv), stdin, stderr, self.assertRaises(SystemExit):
+                main(argv)